@@ -1,115 +1,692 @@
 import json
+import os
+import time
+import types
+import numpy as np
 import pandas as pd
-import osmnx as ox
 import networkx as nx
 import geopy.distance
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import argparse
+from contextlib import contextmanager
 import yaml
 from tqdm import tqdm
+from csr_graph import CSRGraph, load_csr
+from graph_cache import GraphCache
+from hierarchy import load_hierarchy
+from landmarks import load_landmarks
+from graphs import MODES, annotate_components, annotate_corridor, corridor_widths, haversine, index_nodes, load_data_graph, load_graph, mode_weight, parse_geo, route_mode
+from route_store import RouteStore
+from routing import MANY_SEARCHES, SEARCHES, SPARSE_DETOUR, SPARSE_MARGIN, SearchBudgetExceeded, uses_corridor
+from shared_graph import SharedGraph
+from snapping import SnapCache, snap_routes
+from tiles import TileStore
 
 
-def cached_nearest_node(G, lat, lon, nearest_node_cache = {}):
+# Outcome recorded for routes whose search ran out of budget
+BUDGET_EXCEEDED = "budget exceeded"
+
+# Status codes of computed routes, as returned by compute_single_route
+ROUTE_OK = 0
+ROUTE_FAILED = 1
+ROUTE_BUDGET_EXCEEDED = 2
+
+# Routing state of a pool worker process, set once by init_route_worker
+_worker = {}
+
+# Adaptive chunk size: aim for this many chunks per worker, of at most MAX_CHUNK_ROUTES routes
+CHUNKS_PER_WORKER = 4
+MAX_CHUNK_ROUTES = 256
+# Chunks submitted to the pool ahead of the results, per worker
+IN_FLIGHT_PER_WORKER = 2
+# Routes shorter than this (m) are costed as this long, for the fixed work every route takes
+MIN_COST_DISTANCE = 500
+
+
+########################
+# 3) The heavy-lifting function: computes one route
+########################
+def route_on_graph(G, start_node, end_node, mode, corridor_width=None, budget=None):
     """
-    Returns the nearest node in G for the given (lat, lon).
-    Uses an in-memory cache to speed up repeated lookups.
+    Routes between two snapped nodes of the "all" network G using the edges
+    open to mode. With a corridor_width, the search first stays within that many
+    meters of the observed trajectories and widens the corridor when no path is found.
+    With a budget, no path longer than budget meters is searched for and
+    SearchBudgetExceeded is raised instead.
+    G must have been numbered by graphs.index_nodes.
+    Returns the route as an int32 array of node indices (see route_coords).
     """
-    key = (lat, lon)
-    if key not in nearest_node_cache:
-        # Actually find the nearest node
-        # (Note: OSMnx expects (lon, lat) ordering in nearest_nodes)
-        node = ox.distance.nearest_nodes(G, X=lon, Y=lat)
-        nearest_node_cache[key] = node
-        return node
-    return nearest_node_cache[key]
+    # check is start and end in node
+    if start_node not in G.nodes() or end_node not in G.nodes():
+        print(f"Start or end node not found in graph: {start_node} -> {end_node}")
+
+    # Nodes in different strongly connected components cannot reach each other
+    component = f"component_{mode}"
+    if G.nodes[start_node][component] != G.nodes[end_node][component]:
+        raise nx.NetworkXNoPath(f"{start_node} and {end_node} are in different {mode} components")
 
-def get_nearest_node(G, lat, lon):
+    # Compute shortest path over the edges open to this mode
+    for width in corridor_widths(corridor_width):
+        try:
+            weight = mode_weight(mode, G, width, targets=(end_node,))
+            if budget is None:
+                route = nx.shortest_path(G, start_node, end_node, weight=weight)
+            else:
+                _, route = nx.single_source_dijkstra(G, start_node, end_node, cutoff=budget, weight=weight)
+            break
+        except nx.NetworkXNoPath:
+            if width is None:
+                if budget is not None:
+                    raise SearchBudgetExceeded(f"No path under {budget:.0f} m between {start_node} and {end_node}")
+                raise
+
+    index = G.graph["node_index"]
+    return np.fromiter((index[n] for n in route), dtype=np.int32, count=len(route))
+
+def search_corridor(graph, backend, mode, corridor_width):
     """
-    Returns the nearest node in G for the given (lat, lon).
+    Returns the corridor width the searches of backend for mode keep to on
+    graph, None when they search the whole graph.
     """
-    node = ox.distance.nearest_nodes(G, X=lon, Y=lat)
-    return node
+    if not corridor_width:
+        return None
+    if isinstance(graph, CSRGraph) and (graph.corridor is None or not uses_corridor(graph, backend, mode)):
+        return None
+    return corridor_width
 
-########################
-# 3) The heavy-lifting function: computes one route
-########################
-def compute_single_route(activity, walk_graph, drive_graph, nearest_node_cache={}):
+def route_on_csr(csr, start_node, end_node, mode, corridor_width=None, backend="csr", budget=None):
     """
-    activity: a dictionary with 'type', 'time', 'start', 'end'.
-    Returns a dict with route info or None if error.
+    Same as route_on_graph, searching the compact CSRGraph directly with the
+    search routing.SEARCHES holds for backend. Nodes are CSR node indices.
+    Returns the route as an int32 array of node indices.
+    """
+    search = SEARCHES[backend]
+    # Nodes in different strongly connected components cannot reach each other
+    components = csr.components[mode]
+    if components[start_node] != components[end_node]:
+        raise ValueError(f"{csr.osmids[start_node]} and {csr.osmids[end_node]} are in different {mode} components")
+
+    # Searches over the whole graph are run once rather than once per corridor width
+    corridor_width = search_corridor(csr, backend, mode, corridor_width)
+    for width in corridor_widths(corridor_width):
+        route = search(csr, start_node, end_node, mode, width, budget)
+        if route is not None:
+            break
+    else:
+        if budget is not None:
+            raise SearchBudgetExceeded(f"No path under {budget:.0f} m between "
+                                       f"{csr.osmids[start_node]} and {csr.osmids[end_node]}")
+        raise ValueError(f"No path between {csr.osmids[start_node]} and {csr.osmids[end_node]}")
+
+    return np.array(route, dtype=np.int32)
+
+def route_coords(graph, path):
+    """
+    Returns the (n, 2) array of (lat, lon) of a route computed on graph, in one
+    fancy-indexing step. Routes on a TileStore already are coordinates.
+    """
+    if isinstance(graph, TileStore):
+        return path
+    if isinstance(graph, CSRGraph):
+        return graph.path_coords(path)
+    return graph.graph["node_coords"][path]
+
+def route_length(graph, path, mode):
+    """
+    Returns the length in meters of a route computed on graph, adding up the
+    shortest edge open to mode between each pair of nodes as the searches do.
+    """
+    if isinstance(graph, CSRGraph):
+        return graph.path_length(path, mode)
+    nodes = graph.graph["node_ids"]
+    weight = mode_weight(mode)
+    pairs = zip(path[:-1].tolist(), path[1:].tolist())
+    return sum(weight(nodes[u], nodes[v], graph[nodes[u]][nodes[v]]) for u, v in pairs)
+
+def route_result(activity, route_coords):
+    """
+    Returns the output dict of a computed route, with its coordinates as an
+    (n, 2) array of (lat, lon).
+    """
+    return {
+        'type': activity['type'],
+        'time': activity['time'],
+        'start': activity['start'],
+        'end': activity['end'],
+        'coords': route_coords
+    }
+
+def search_budget(activity, budget_factor, budget_margin):
+    """
+    Returns the longest route worth searching for, in meters: budget_factor
+    times the straight-line distance between the endpoints, or the recorded
+    distance if longer, plus budget_margin. None without a budget_factor.
+    """
+    if not budget_factor:
+        return None
+    distance = haversine(*parse_geo(activity['start']), *parse_geo(activity['end']))
+    distance = max(distance, activity.get('distance') or 0.0)
+    return budget_factor * distance + budget_margin
+
+def repeat_result(activity, result):
+    """
+    Returns the route dict of activity from the result of an identical route,
+    keeping its coordinates and outcome. None if that route failed.
+    """
+    if result is None:
+        return None
+    return dict(result, **{key: activity[key] for key in ('type', 'time', 'start', 'end')})
+
+def exceeded_result(activity):
+    """
+    Returns the output dict of a route whose search ran out of budget.
+    """
+    result = route_result(activity, None)
+    result['outcome'] = BUDGET_EXCEEDED
+    return result
+
+def route_many_on_csr(csr, start_node, end_nodes, mode, corridor_width=None, backend="csr", budgets=None):
+    """
+    Routes from one CSR node to several with a single search from
+    routing.MANY_SEARCHES (see routing.dijkstra_many), widening the corridor
+    for the routes it misses. end_nodes may repeat, and budgets, if given,
+    holds the budget in meters of each route, so every route is checked
+    against its own budget as route_on_csr would.
+    Returns an int32 array of node indices per route, or None if unreachable
+    (or further than its budget).
+    """
+    search_many = MANY_SEARCHES[backend]
+    components = csr.components[mode]
+    routes = [None] * len(end_nodes)
+    remaining = [k for k, end in enumerate(end_nodes) if components[end] == components[start_node]]
+    corridor_width = search_corridor(csr, backend, mode, corridor_width)
+    for width in corridor_widths(corridor_width):
+        if not remaining:
+            break
+        limit = None if budgets is None else max(budgets[k] for k in remaining)
+        found = search_many(csr, start_node, {end_nodes[k] for k in remaining}, mode, width, limit)
+        for k in remaining:
+            route = found[end_nodes[k]]
+            if route is not None and (budgets is None or route[0] <= budgets[k]):
+                routes[k] = np.array(route[1], dtype=np.int32)
+        remaining = [k for k in remaining if routes[k] is None]
+    return routes
+
+def route_many_on_graph(G, start_node, end_nodes, mode, corridor_width=None, budgets=None):
+    """
+    Same as route_many_on_csr on the "all" network G: one networkx Dijkstra
+    from start_node, first limited to SPARSE_DETOUR times the furthest
+    straight-line distance to an end, and repeated for the ends beyond it,
+    without limit or up to the largest budget. Every path is read from the
+    search's predecessor map. Ends outside the corridor can be reached but
+    not crossed, so paths match route_on_graph's.
+    Returns an int32 array of node indices per route, or None.
+    """
+    component = f"component_{mode}"
+    index = G.graph["node_index"]
+    start = G.nodes[start_node]
+    routes = [None] * len(end_nodes)
+    remaining = [k for k, end in enumerate(end_nodes) if G.nodes[end][component] == start[component]]
+    for width in corridor_widths(corridor_width):
+        if not remaining:
+            break
+        ends = {end_nodes[k] for k in remaining}
+        base_weight = mode_weight(mode, G, width, targets=ends)
+        if width is None:
+            weight = base_weight
+        else:
+            def weight(u, v, edges):
+                if u != start_node and G.nodes[u]["corridor"] > width:
+                    return None
+                return base_weight(u, v, edges)
+        budget = None if budgets is None else max(budgets[k] for k in remaining)
+        furthest = max(haversine(start["y"], start["x"], G.nodes[end]["y"], G.nodes[end]["x"]) for end in ends)
+        first_limit = SPARSE_DETOUR * furthest + SPARSE_MARGIN
+        for limit in (first_limit if budget is None else min(first_limit, budget), budget):
+            predecessors, distances = nx.dijkstra_predecessor_and_distance(G, start_node, cutoff=limit,
+                                                                           weight=weight)
+            for k in remaining:
+                end = end_nodes[k]
+                if end not in distances or (budgets is not None and distances[end] > budgets[k]):
+                    continue
+                path = [end]
+                while path[-1] != start_node:
+                    path.append(predecessors[path[-1]][0])
+                routes[k] = np.fromiter((index[n] for n in reversed(path)), dtype=np.int32, count=len(path))
+            remaining = [k for k in remaining if routes[k] is None]
+            if not remaining or limit == budget:
+                break
+    return routes
+
+def shares_search(graph, backend):
+    """
+    Tells whether routes leaving the same node share one search on graph:
+    on the networkx graph, and with the backends of routing.MANY_SEARCHES
+    on a CSRGraph.
+    """
+    if isinstance(graph, CSRGraph):
+        return backend in MANY_SEARCHES
+    return not isinstance(graph, TileStore)
+
+def compute_route_group(activities, graph, corridor_width=None, backend="csr"):
+    """
+    Routes activities sharing a mode and start node (see group_routes).
+    On the networkx graph, and with the csr and scipy backends, one search
+    from the shared start reaches every end, each within its own 'budget';
+    other backends route each activity on its own (see shares_search).
+    Returns a (status, path) pair per activity, see compute_single_route.
+    """
+    if len(activities) == 1 or not shares_search(graph, backend):
+        return [compute_single_route(activity, graph, corridor_width, backend) for activity in activities]
+
+    mode = route_mode(activities[0])
+    budgets = None
+    if all(activity.get('budget') is not None for activity in activities):
+        budgets = [activity['budget'] for activity in activities]
+    start_node = activities[0]['start_node']
+    end_nodes = [activity['end_node'] for activity in activities]
+    try:
+        if isinstance(graph, CSRGraph):
+            routes = route_many_on_csr(graph, start_node, end_nodes, mode, corridor_width, backend, budgets)
+        else:
+            routes = route_many_on_graph(graph, start_node, end_nodes, mode, corridor_width, budgets)
+    except Exception as e:
+        print(f"Error computing routes from {activities[0]['start']} -> {e}")
+        return [(ROUTE_FAILED, None)] * len(activities)
+
+    if isinstance(graph, CSRGraph):
+        component, osmid = graph.components[mode].__getitem__, graph.osmids.__getitem__
+    else:
+        component, osmid = (lambda n: graph.nodes[n][f"component_{mode}"]), (lambda n: n)
+    results = []
+    for activity, path in zip(activities, routes):
+        if path is None and budgets is not None and \
+                component(activity['start_node']) == component(activity['end_node']):
+            print(f"Search budget exceeded for {activity}")
+            results.append((ROUTE_BUDGET_EXCEEDED, None))
+        elif path is None:
+            print(f"Error computing route for {activity} -> no path between "
+                  f"{osmid(activity['start_node'])} and {osmid(activity['end_node'])}")
+            results.append((ROUTE_FAILED, None))
+        else:
+            results.append((ROUTE_OK, path))
+    return results
+
+def compute_single_route(activity, graph, corridor_width=None, backend="csr"):
+    """
+    activity: a dictionary with 'type', 'time', 'start', 'end', and the snapped
+    'start_node' and 'end_node' (see snapping.snap_routes) unless graph is a TileStore.
+    graph: the "all" network, walk and drive are selected by its edge mode masks,
+    its CSRGraph form, or a TileStore for tiled routing.
+    activity may also carry a search 'budget' in meters (see search_budget).
+    corridor_width: see route_on_graph.
+    backend: the search run on a CSRGraph, see route_on_csr.
+    Returns (status, path): ROUTE_OK with the route's int32 node indices
+    (coordinates on a TileStore, see route_coords), or ROUTE_FAILED or
+    ROUTE_BUDGET_EXCEEDED with None.
     """
     try:
-        # Extract lat,lon from 'start' and 'end'
-        start_coords = tuple(map(float, activity['start'].split(':')[1].split(',')))
-        end_coords   = tuple(map(float, activity['end'].split(':')[1].split(',')))
-
-        # Pick the graph based on mode
-        mode = 'walk' if 'walking' in activity['type'].lower() else 'drive'
-        G = walk_graph if mode == 'walk' else drive_graph
-
-        # Nearest nodes
-        #start_node = cached_nearest_node(G, start_coords[0], start_coords[1])
-        #end_node   = cached_nearest_node(G, end_coords[0], end_coords[1])
-        start_node = get_nearest_node(G, start_coords[0], start_coords[1])
-        end_node   = get_nearest_node(G, end_coords[0], end_coords[1])
-        # check is start and end in node
-        if start_node not in G.nodes() or end_node not in G.nodes():
-            print(f"Start or end node not found in graph for {activity}")
-
-        # Compute shortest path
-        route = nx.shortest_path(G, start_node, end_node, weight='length')
-
-        # Build route coordinate list
-        route_coords = [(G.nodes[n]['y'], G.nodes[n]['x']) for n in route]
-
-        return {
-            'type': activity['type'],
-            'time': activity['time'],
-            'start': activity['start'],
-            'end': activity['end'],
-            'coords': route_coords
-        }
+        # Pick the mode mask
+        mode = route_mode(activity)
+        if isinstance(graph, TileStore):
+            # Tiles are loaded as the endpoints and the search frontier reach them
+            path = np.array(graph.route(parse_geo(activity['start']), parse_geo(activity['end']), mode,
+                                        activity.get('budget')))
+        elif isinstance(graph, CSRGraph):
+            path = route_on_csr(graph, activity['start_node'], activity['end_node'], mode, corridor_width,
+                                backend, activity.get('budget'))
+        else:
+            path = route_on_graph(graph, activity['start_node'], activity['end_node'], mode, corridor_width,
+                                  activity.get('budget'))
+        return ROUTE_OK, path
+
+    except SearchBudgetExceeded as e:
+        print(f"Search budget exceeded for {activity} -> {e}")
+        return ROUTE_BUDGET_EXCEEDED, None
 
     except Exception as e:
         # In parallel mode, we typically return None or some error indicator.
         print(f"Error computing route for {activity} -> {e}")
-        return None
+        return ROUTE_FAILED, None
+
+def init_route_worker(graph, corridor_width=None, backend="csr"):
+    """
+    Pool initializer: receives the graph and routing settings once per worker
+    process, so tasks only carry their activities. A SharedGraph is attached
+    to in place rather than copied.
+    """
+    if isinstance(graph, SharedGraph):
+        # Keep the block open for as long as the worker routes on its views
+        _worker["shared"] = graph
+        graph = graph.attach()
+    _worker["graph"] = graph
+    _worker["corridor_width"] = corridor_width
+    _worker["backend"] = backend
+
+def compute_route_task(chunk):
+    """
+    Worker entry point: routes a chunk of (indices, activities) groups on the
+    worker's graph (see init_route_worker) and returns a compact
+    (task index, status, path) triple per activity, which the parent turns
+    back into route dicts with rehydrate_route.
+    """
+    triples = []
+    for indices, activities in chunk:
+        results = compute_route_group(activities, _worker["graph"], _worker["corridor_width"], _worker["backend"])
+        triples.extend((i, status, path) for i, (status, path) in zip(indices, results))
+    return triples
+
+def rehydrate_route(activity, graph, status, path):
+    """
+    Returns the route dict of a computed (status, path), None if it failed.
+    """
+    if status == ROUTE_OK:
+        return route_result(activity, route_coords(graph, path))
+    if status == ROUTE_BUDGET_EXCEEDED:
+        return exceeded_result(activity)
+    return None
+
+def group_routes(activities):
+    """
+    Groups the indices of routes by (mode, start node), in order of first
+    appearance. Routes without snapped nodes (tiled routing) each form their own group.
+    """
+    groups = {}
+    for i, activity in enumerate(activities):
+        key = (route_mode(activity), activity['start_node']) if 'start_node' in activity else i
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+def route_store_hooks(graph, route_store, corridor_width, backend="networkx"):
+    """
+    Returns the lookup and store hooks of parallel_preprocess_routes that serve
+    the routes route_store already holds and store every route computed, so
+    each (mode, start node, end node) is routed once across runs. Routes are
+    scoped by the corridor the backend's searches for their mode keep to (see
+    search_corridor). A stored route longer than an activity's 'budget'
+    counts as exceeding it.
+    Returns (None, None) without a store, for tiled routing, or for a graph
+    without a fingerprint.
+    """
+    if route_store is None or isinstance(graph, TileStore):
+        return None, None
+    widths = {mode: search_corridor(graph, backend, mode, corridor_width) for mode in MODES}
+    scopes = {mode: route_store.scope(graph, width) for mode, width in widths.items()}
+    if None in scopes.values():
+        return None, None
+
+    def lookup(activity):
+        mode = route_mode(activity)
+        stored = route_store.get(scopes[mode], mode, activity['start_node'], activity['end_node'])
+        if stored is None:
+            return None
+        route_coords, length = stored
+        if activity.get('budget') is not None and length > activity['budget']:
+            # Without a corridor the stored route is the shortest path, so the search would
+            # run out of budget too; a wider corridor may still hold a shorter path
+            return None if widths[mode] else exceeded_result(activity)
+        return route_result(activity, route_coords)
+
+    def store(activity, result, path):
+        # Routes that ran out of budget are searched again next run
+        if result['coords'] is not None:
+            mode = route_mode(activity)
+            route_store.put(scopes[mode], mode, activity['start_node'], activity['end_node'],
+                            result['coords'], route_length(graph, path, mode))
+
+    return lookup, store
+
+def same_region_routes(routes, point_regions):
+    """
+    Keeps the routes whose start and end fall in the same region.
+    """
+    kept = [r for r in routes if point_regions[r["start"]] == point_regions[r["end"]]]
+    if len(kept) < len(routes):
+        print(f"Skipping {len(routes) - len(kept)} routes that cross between regions")
+    return kept
 
 ########################
 # 4) Parallel route preprocessing
 ########################
-def parallel_preprocess_routes(activities, walk_graph, drive_graph, max_workers=4,nearest_node_cache={}):
+def mode_density(graph):
+    """
+    Returns the share of the graph's nodes open to each mode, which scales
+    how many nodes a search of that mode settles. 1 for a TileStore.
+    """
+    if isinstance(graph, TileStore):
+        return {mode: 1.0 for mode in MODES}
+    if isinstance(graph, CSRGraph):
+        node_modes = graph.node_modes()
+    else:
+        node_modes = np.fromiter((modes for _, modes in graph.nodes(data="modes", default=0)), dtype=np.uint8)
+    return {mode: max(float(np.mean((node_modes & bit) != 0)), 1e-3) for mode, bit in MODES.items()}
+
+def route_cost(activity, density):
+    """
+    Estimates the work of routing activity: a search settles the nodes within
+    about the straight-line distance, so cost grows with its square.
+    """
+    start_lat, start_lon = parse_geo(activity['start'])
+    end_lat, end_lon = parse_geo(activity['end'])
+    distance = max(haversine(start_lat, start_lon, end_lat, end_lon), MIN_COST_DISTANCE)
+    return density[route_mode(activity)] * distance ** 2
+
+def route_chunks(groups, activities, chunk_size, costs=None, chunk_cost=None):
+    """
+    Yields chunks of whole route groups holding about chunk_size routes each,
+    as (number of routes, [(indices, activities), ...]). With costs per group,
+    a chunk is also closed once it reaches chunk_cost.
+    """
+    chunk, size, cost = [], 0, 0.0
+    for k, group in enumerate(groups):
+        chunk.append((group, [activities[i] for i in group]))
+        size += len(group)
+        if costs is not None:
+            cost += costs[k]
+        if size >= chunk_size or (chunk_cost is not None and cost >= chunk_cost):
+            yield size, chunk
+            chunk, size, cost = [], 0, 0.0
+    if chunk:
+        yield size, chunk
+
+@contextmanager
+def route_pool(graph, max_workers=4, corridor_width=None, backend="csr"):
+    """
+    Starts the worker pool routes are computed in, each worker receiving the
+    graph once (see init_route_worker). CSR arrays go to shared memory, so
+    every worker maps the same copy; the block is freed with the pool.
+    """
+    shared = SharedGraph.export(graph) if isinstance(graph, CSRGraph) else None
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_route_worker,
+                                 initargs=(shared or graph, corridor_width, backend)) as executor:
+            yield executor
+    finally:
+        if shared is not None:
+            shared.close()
+
+def parallel_preprocess_routes(activities, graph, max_workers=4, corridor_width=None, backend="csr", chunk_size=0,
+                               executor=None, desc="Processing routes", window=2000, lookup=None, store=None):
     """
     Parallel version of your preprocess_routes function with progress bar.
+    Activities are planned window routes at a time: repeats of a
+    (mode, start node, end node, budget) are routed once, and the rest is grouped
+    by start node and sent to workers in chunks of about chunk_size routes
+    (0 sizes them from the window and workers), most expensive first (see
+    route_cost), with only a few chunks per worker in flight.
+    executor: a pool from route_pool to share between passes, otherwise one
+    is started for this call.
+    lookup(activity): returns an already known route dict, or None to route it.
+    store(activity, result, path): called with every route dict computed
+    here and its path as returned by compute_single_route.
+    See route_store_hooks for both.
+    Yields a route dict per activity, None where routing failed, in the order
+    of activities. Results wait in a reorder buffer of at most two windows.
+    The routes do not depend on window, except with both a corridor and
+    search budgets: a stored route within budget is then served where a fresh
+    search may have accepted a longer path from a narrower corridor.
     """
-    results = []
+    if executor is None:
+        with route_pool(graph, max_workers, corridor_width, backend) as executor:
+            yield from parallel_preprocess_routes(activities, graph, max_workers, corridor_width, backend,
+                                                  chunk_size, executor, desc, window, lookup, store)
+        return
+
     total = len(activities)
-    
+    num_windows = -(-total // window)
+    if not chunk_size:
+        chunk_size = min(MAX_CHUNK_ROUTES, max(1, -(-min(total, window) // (max_workers * CHUNKS_PER_WORKER))))
+    max_in_flight = max_workers * IN_FLIGHT_PER_WORKER
+    print(f"Routing in windows of {window} routes, chunks of about {chunk_size} routes, "
+          f"at most {max_in_flight} in flight")
+
+    density = mode_density(graph)
+    shared_search = shares_search(graph, backend)
+    # Reorder buffer: task index -> route dict, and repeats waiting on the first of their pair
+    results = {}
+    repeats = {}
+    num_groups = 0
+
     # Create progress bar
-    pbar = tqdm(total=total, desc="Processing routes", unit="route")
-    
-    # We'll use ProcessPoolExecutor to parallelize
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_activity = {
-            executor.submit(compute_single_route, activity, walk_graph, drive_graph, nearest_node_cache): activity
-            for activity in activities
-        }
-        for future in as_completed(future_to_activity):
-            res = future.result()
-            if res is not None:
-                results.append(res)
-            pbar.update(1)
-    
+    pbar = tqdm(total=total, desc=desc, unit="route")
+
+    def plan(start):
+        """
+        Resolves the window at start from lookup and repeats, and yields the
+        chunks routing the rest.
+        """
+        nonlocal num_groups
+        first = {}
+        pending = []
+        known_before = len(results)
+        for i in range(start, min(start + window, total)):
+            activity = activities[i]
+            # Repeats share a route only when searched within the same budget
+            key = None
+            if 'start_node' in activity:
+                key = (route_mode(activity), activity['start_node'], activity['end_node'], activity.get('budget'))
+            if key in first:
+                j = first[key]
+                if j in results:
+                    results[i] = repeat_result(activity, results[j])
+                else:
+                    repeats.setdefault(j, []).append(i)
+                continue
+            if key is not None:
+                first[key] = i
+            known = lookup(activity) if lookup is not None else None
+            if known is not None:
+                results[i] = known
+            else:
+                pending.append(i)
+        pbar.update(len(results) - known_before)
+
+        # Routes leaving the same node share one search
+        groups = [[pending[k] for k in group] for group in group_routes([activities[i] for i in pending])]
+        num_groups += len(groups)
+
+        # Longest processing time first: a group's single search costs as much as
+        # its furthest end, otherwise every route searches on its own
+        costs = [(max if shared_search else sum)(route_cost(activities[i], density) for i in group)
+                 for group in groups]
+        order = sorted(range(len(groups)), key=lambda k: costs[k], reverse=True)
+        groups = [groups[k] for k in order]
+        costs = [costs[k] for k in order]
+        chunk_cost = sum(costs) / (max_workers * CHUNKS_PER_WORKER)
+        yield from route_chunks(groups, activities, chunk_size, costs, chunk_cost)
+
+    in_flight = {}
+    finished = 0
+    yielded = 0
+    planned = 0
+    chunks = iter(())
+    # When a worker first ran out of chunks, the rest of the pass waits on stragglers
+    began, idle_since = time.time(), None
+    while yielded < total:
+        # Hand out the finished routes in input order
+        while yielded in results:
+            yield results.pop(yielded)
+            yielded += 1
+        if yielded == total:
+            break
+
+        # Keep the pool fed without queueing the whole history up front; a
+        # window is planned once the one two before it is fully handed out
+        exhausted = True
+        while len(in_flight) < max_in_flight:
+            size_chunk = next(chunks, None)
+            if size_chunk is None:
+                if planned < num_windows and planned * window <= yielded + window:
+                    chunks = plan(planned * window)
+                    planned += 1
+                    continue
+                break
+            size, chunk = size_chunk
+            in_flight[executor.submit(compute_route_task, chunk)] = size
+        else:
+            exhausted = False
+        if exhausted and planned == num_windows and idle_since is None and len(in_flight) < max_workers:
+            idle_since = time.time()
+        if not in_flight:
+            continue
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            # Workers send back node indices only, metadata comes from our own copy
+            routed = in_flight.pop(future)
+            for i, status, path in future.result():
+                results[i] = rehydrate_route(activities[i], graph, status, path)
+                if store is not None and results[i] is not None:
+                    store(activities[i], results[i], path)
+                for j in repeats.pop(i, []):
+                    results[j] = rehydrate_route(activities[j], graph, status, path)
+                    routed += 1
+            finished += 1
+            pbar.set_postfix(chunks=finished)
+            pbar.update(routed)
+
     pbar.close()
-    return results
+    print(f"{num_groups} route groups by mode and start node")
+    if idle_since is not None and total:
+        ended = time.time()
+        print(f"Straggler time: {ended - idle_since:.1f}s of {ended - began:.1f}s with idle workers")
+
+
+def write_output(output_file, sections):
+    """
+    Writes the (key, value) sections as one JSON object, the way json.dump
+    would. Values that are generators are written one element at a time as
+    they are produced, so routes stream to disk instead of piling up.
+    The file only replaces output_file once it is complete.
+    """
+    def dump(value, f):
+        json.dump(value, f, default=lambda coords: coords.tolist())
+
+    with open(output_file + ".tmp", "w") as f:
+        f.write("{")
+        for k, (key, value) in enumerate(sections):
+            f.write(", " if k else "")
+            f.write(json.dumps(key) + ": ")
+            if not isinstance(value, types.GeneratorType):
+                dump(value, f)
+                continue
+            f.write("[")
+            for n, item in enumerate(value):
+                f.write(", " if n else "")
+                dump(item, f)
+            f.write("]")
+        f.write("}")
+    os.replace(output_file + ".tmp", output_file)
 
 
-def main(location_path, start, end, center_point, dist, output_file):
+def main(location_path, start, end, center_point, dist, output_file, graph_cache=None,
+         extent="point", region_gap=5000, region_buffer=1000, corridor_width=0, tile_store=None,
+         routing_backend="networkx", osm_extract=None, largest_component=False,
+         snap_cache=None, hierarchy_modes=("drive",), landmark_modes=(), landmark_count=16,
+         route_store=None, budget_factor=0, budget_margin=1000, chunk_size=0, route_window=2000):
     # ------------
     # Load & prep data
     # ------------
-    walk_graph = ox.graph_from_point(center_point, dist=dist, network_type="walk", simplify=True)
-    drive_graph = ox.graph_from_point(center_point, dist=dist, network_type="drive", simplify=True)
     print("Loading and preparing data...")
     path = location_path
     with open(path) as f:
@@ -150,7 +727,8 @@ def main(location_path, start, end, center_point, dist, output_file):
             "point": el["start"],
             "type":  el["topCandidate"]["type"],
             "start": el["start"],
-            "end":   el["end"]
+            "end":   el["end"],
+            "distance": float(el["distanceMeters"]) if el.get("distanceMeters") else None
         })
 
     # Prepare visits
@@ -163,6 +741,32 @@ def main(location_path, start, end, center_point, dist, output_file):
             "point": el["topCandidate"]["placeLocation"]
         })
 
+    # ------------
+    # Load road graph
+    # ------------
+    print("Loading road graph...")
+    point_regions = None
+    if extent == "tiles":
+        # Fetch the tiles holding route endpoints now; the rest load on demand
+        geo_points = [el["point"] for el in data_timeline]
+        geo_points += [el[key] for el in data_activity for key in ("start", "end")]
+        tile_ids = {tile_store.tile_id(*parse_geo(p)) for p in set(geo_points)}
+        print(f"Preparing {len(tile_ids)} endpoint tiles...")
+        tile_store.ensure(sorted(tile_ids))
+        graph = tile_store
+    elif extent == "data":
+        # Fit the graph to the places actually visited
+        geo_points = [el["point"] for el in data_timeline + data_visits]
+        geo_points += [el[key] for el in data_activity for key in ("start", "end")]
+        geo_points = list(dict.fromkeys(geo_points))
+        graph, region_ids = load_data_graph(
+            [parse_geo(p) for p in geo_points], region_gap, region_buffer,
+            graph_cache=graph_cache, extract=osm_extract,
+        )
+        point_regions = dict(zip(geo_points, region_ids))
+    else:
+        graph = load_graph(center_point, dist, graph_cache=graph_cache, extract=osm_extract)
+
     # Build timeline routes
     print("Building timeline routes...")
     data_timelines_routes = []
@@ -196,36 +800,97 @@ def main(location_path, start, end, center_point, dist, output_file):
             "type":  typething
         })
 
-    nearest_node_cache = {}
+    if point_regions is not None:
+        # Routes can only be computed inside a single region graph
+        data_timelines_routes_distance = same_region_routes(data_timelines_routes_distance, point_regions)
+        data_activity = same_region_routes(data_activity, point_regions)
+
+    if budget_factor:
+        # Give up on routes far longer than their endpoints suggest
+        for route in data_timelines_routes_distance + data_activity:
+            route["budget"] = search_budget(route, budget_factor, budget_margin)
+
+    if extent != "tiles":
+        print("Labelling strongly connected components...")
+        annotate_components(graph)
+        if routing_backend == "networkx":
+            index_nodes(graph)
+
+    if corridor_width and extent != "tiles":
+        # Prune searches to a corridor around the observed trajectories
+        segments = [(parse_geo(r["start"]), parse_geo(r["end"]))
+                    for r in data_timelines_routes_distance + data_activity]
+        annotate_corridor(graph, segments, corridor_width)
+
+    if routing_backend != "networkx" and extent != "tiles":
+        print("Converting road graph to CSR arrays...")
+        graph = load_csr(graph, graph_cache, corridor=bool(corridor_width))
+        if routing_backend in ("astar", "ch"):
+            # Built once here so workers receive the backward edges with the graph
+            graph.reverse()
+        if routing_backend == "ch":
+            for mode in hierarchy_modes:
+                graph.hierarchies[mode] = load_hierarchy(graph, mode, graph_cache)
+        if routing_backend == "scipy":
+            # Built once here so workers receive the matrices with the graph
+            for mode in MODES:
+                graph.matrices[mode] = graph.to_scipy(mode)
+        if routing_backend in ("astar", "ch"):
+            for mode in landmark_modes:
+                graph.landmarks[mode] = load_landmarks(graph, mode, landmark_count, graph_cache)
+        print(f"CSR graph: {graph.num_nodes} nodes, {graph.num_edges} edges")
+    if graph_cache is not None:
+        print(f"Graph cache: {graph_cache.stats()}")
+
+    if extent != "tiles":
+        # Snap all endpoints up front, workers then only search
+        print("Snapping route endpoints...")
+        snap_routes(data_timelines_routes_distance + data_activity, graph, largest_component, snap_cache)
+        if snap_cache is not None:
+            snap_cache.save()
+            print(f"Snap cache: {snap_cache.stats()}")
+
     # ------------
     # Process routes
     # ------------
-    # Process timeline routes in parallel
-    print(f"\nProcessing {len(data_timelines_routes_distance)} timeline routes...")
-    parallel_routes_timeline = parallel_preprocess_routes(data_timelines_routes_distance, walk_graph, drive_graph, max_workers=max_workers, nearest_node_cache=nearest_node_cache)
-    
-    # Process activity routes sequentially
-    nearest_node_cache = {}
-    print(f"\nProcessing {len(data_activity)} activity routes...")
-    routes_activity = []
-    for activity in tqdm(data_activity, desc="Processing activity routes", unit="route"):
-        route = compute_single_route(activity, walk_graph, drive_graph, nearest_node_cache=nearest_node_cache)
-        if route is not None:
-            routes_activity.append(route)
+    # Timeline and activity routes are processed in parallel, in one pool,
+    # and stream to the output file in their original order
+    budget_exceeded = []
+    lookup, store = route_store_hooks(graph, route_store, corridor_width, routing_backend)
+    with route_pool(graph, max_workers, corridor_width, routing_backend) as executor:
+        def stream_routes(routes, kind):
+            print(f"\nProcessing {len(routes)} {kind} routes...")
+            for route in parallel_preprocess_routes(
+                    routes, graph, max_workers=max_workers, corridor_width=corridor_width, backend=routing_backend,
+                    chunk_size=chunk_size, executor=executor, desc=f"Processing {kind} routes", window=route_window,
+                    lookup=lookup, store=store):
+                if route is None:
+                    continue
+                # Keep routes that ran out of search budget apart from the computed ones
+                if route.get("outcome") == BUDGET_EXCEEDED:
+                    budget_exceeded.append({k: route[k] for k in ("type", "time", "start", "end")})
+                else:
+                    yield route
 
-    # ------------
-    # Save output
-    # ------------
-    print("\nSaving preprocessed data...")
-    with open(output_file, "w") as f:
-        json.dump({
-            "routes":          routes_activity,
-            "routes_timeline": parallel_routes_timeline,
-            "timeline":        data_timeline,
-            "visits":          data_visits
-        }, f)
+        # ------------
+        # Save output
+        # ------------
+        print("\nSaving preprocessed data...")
+        write_output(output_file, [
+            ("routes",          stream_routes(data_activity, "activity")),
+            ("routes_timeline", stream_routes(data_timelines_routes_distance, "timeline")),
+            ("timeline",        data_timeline),
+            ("visits",          data_visits),
+            ("budget_exceeded", budget_exceeded),
+        ])
+    if route_store is not None:
+        route_store.save()
+    if budget_exceeded:
+        print(f"{len(budget_exceeded)} routes exceeded their search budget")
 
     print(f"Preprocessing complete. Data saved to {output_file}")
+    if route_store is not None:
+        print(f"Route store: {route_store.stats()}")
 
 if __name__ == "__main__":
     # Set up argument parser
@@ -244,6 +909,46 @@ if __name__ == "__main__":
         center_point = config["map"]["center_point"]
         dist = config["map"]["dist"]
         max_workers = config["compute"]["max_workers"]
+        chunk_size = config["compute"].get("chunk_size", 0)
+        route_window = config["compute"].get("route_window", 2000)
         center_point = tuple(config["map"]["center_point"])
+        extent = config["map"].get("extent", "point")
+        region_gap = config["map"].get("region_gap", 5000)
+        region_buffer = config["map"].get("region_buffer", 1000)
+        corridor_width = config["compute"].get("corridor_width", 0)
+        budget_factor = config["compute"].get("search_budget", 0)
+        budget_margin = config["compute"].get("search_budget_margin", 1000)
+        routing_backend = config.get("routing", {}).get("backend", "networkx")
+        hierarchy_modes = config.get("routing", {}).get("hierarchy_modes", ["drive"])
+        landmark_modes = config.get("routing", {}).get("landmark_modes", [])
+        landmark_count = config.get("routing", {}).get("landmarks", 16)
+        osm_extract = config["map"].get("osm_extract") or None
+        largest_component = config["compute"].get("snap_to_largest_component", False)
+        snap_cache = SnapCache(
+            config["compute"].get("snap_cache_file", "cache/snap_cache.pkl"),
+            max_size_mb=config["compute"].get("cache_size", 1000),
+            precision=config["compute"].get("snap_precision", 6),
+        )
+        route_store = RouteStore(
+            config["compute"].get("route_store_file", "cache/routes.sqlite"),
+            max_size_mb=config["compute"].get("route_store_size", 500),
+        )
+        tile_store = None
+        if extent == "tiles":
+            tile_store = TileStore(
+                config["map"].get("tile_dir", "cache/tiles"),
+                tile_size=config["map"].get("tile_size", 0.1),
+                max_memory_mb=config["compute"].get("tile_memory", 1000),
+            )
+        graph_cache = GraphCache(
+            config["compute"].get("graph_cache_dir", "cache/graphs"),
+            max_size_mb=config["compute"].get("graph_cache_size", 2000),
+        )
 
-    main(input_file, start, end, center_point, dist, output_file)
+    main(input_file, start, end, center_point, dist, output_file, graph_cache=graph_cache,
+         extent=extent, region_gap=region_gap, region_buffer=region_buffer,
+         corridor_width=corridor_width, tile_store=tile_store, routing_backend=routing_backend,
+         osm_extract=osm_extract, largest_component=largest_component, snap_cache=snap_cache,
+         hierarchy_modes=hierarchy_modes, landmark_modes=landmark_modes, landmark_count=landmark_count,
+         route_store=route_store, budget_factor=budget_factor, budget_margin=budget_margin,
+         chunk_size=chunk_size, route_window=route_window)
@@ -0,0 +1,239 @@
+import struct
+import zipfile
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from graphs import DRIVE, MODES, WALK
+
+
+class CSRGraph:
+    """
+    Compact array-backed copy of an "all" network.
+    Node i has its outgoing edges at targets[offsets[i]:offsets[i + 1]], with
+    float32 lengths and mode bitmasks alongside. Parallel edges are collapsed
+    to the shortest one per mode. Nodes keep their lat/lon and original OSM ids.
+    """
+
+    ARRAYS = ("offsets", "targets", "lengths", "modes", "lat", "lon", "osmids")
+
+    def __init__(self, offsets, targets, lengths, modes, lat, lon, osmids, fingerprint=None):
+        self.offsets = offsets
+        self.targets = targets
+        self.lengths = lengths
+        self.modes = modes
+        self.lat = lat
+        self.lon = lon
+        self.osmids = osmids
+        self.fingerprint = fingerprint
+        # Optional per-node distance to the observed trajectories, see graphs.annotate_corridor
+        self.corridor = None
+        # Optional per-mode strongly connected component ids, see graphs.annotate_components
+        self.components = {}
+        # Optional per-mode contraction hierarchies, see hierarchy.ContractionHierarchy
+        self.hierarchies = {}
+        # Optional per-mode landmark distance tables, see landmarks.LandmarkTable
+        self.landmarks = {}
+        # Optional per-mode scipy.sparse adjacency matrices, see to_scipy
+        self.matrices = {}
+        self._index = None
+        self._coords = None
+        self._reverse = None
+
+    def __getstate__(self):
+        # Lookup structures are rebuilt on demand rather than pickled
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    @property
+    def num_nodes(self):
+        return len(self.osmids)
+
+    @property
+    def num_edges(self):
+        return len(self.targets)
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        Converts an "all" network with mode masks to CSR form.
+        """
+        osmids = np.fromiter(G.nodes, dtype=np.int64, count=G.number_of_nodes())
+        index = {osmid: i for i, osmid in enumerate(osmids.tolist())}
+        lat = np.array([G.nodes[n]["y"] for n in osmids.tolist()], dtype=np.float64)
+        lon = np.array([G.nodes[n]["x"] for n in osmids.tolist()], dtype=np.float64)
+
+        offsets = np.zeros(len(osmids) + 1, dtype=np.int64)
+        targets, lengths, modes = [], [], []
+        for i, u in enumerate(osmids.tolist()):
+            for v, edges in G.adj[u].items():
+                best = {}
+                for data in edges.values():
+                    for bit in (WALK, DRIVE):
+                        if data["modes"] & bit and data["length"] < best.get(bit, np.inf):
+                            best[bit] = data["length"]
+                if len(best) == 2 and best[WALK] == best[DRIVE]:
+                    best = {WALK | DRIVE: best[WALK]}
+                for bit, length in best.items():
+                    targets.append(index[v])
+                    lengths.append(length)
+                    modes.append(bit)
+            offsets[i + 1] = len(targets)
+
+        return cls(
+            offsets,
+            np.array(targets, dtype=np.int32),
+            np.array(lengths, dtype=np.float32),
+            np.array(modes, dtype=np.uint8),
+            lat,
+            lon,
+            osmids,
+            fingerprint=G.graph.get("fingerprint"),
+        )
+
+    def save(self, path):
+        """
+        Saves the arrays as an uncompressed .npz, which load() can memory-map.
+        """
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        arrays["fingerprint"] = np.array(self.fingerprint or "")
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a graph saved by save(), memory-mapping its arrays by default.
+        """
+        arrays = load_npz(path, mmap=mmap)
+        fingerprint = str(arrays.pop("fingerprint")) or None
+        return cls(**{name: arrays[name] for name in cls.ARRAYS}, fingerprint=fingerprint)
+
+    def index_of(self, osmid):
+        """
+        Returns the node index of an OSM id.
+        """
+        if self._index is None:
+            self._index = {osmid: i for i, osmid in enumerate(self.osmids.tolist())}
+        return self._index[osmid]
+
+    def path_coords(self, path):
+        """
+        Returns the (lat, lon) of the nodes on path as an (n, 2) float64 array.
+        """
+        if self._coords is None:
+            self._coords = np.column_stack((self.lat, self.lon))
+        return self._coords[path]
+
+    def path_length(self, path, mode):
+        """
+        Returns the length in meters of path over the edges open to mode,
+        summed in the order the searches add them up.
+        """
+        bit = MODES[mode]
+        length = 0.0
+        for u, v in zip(path[:-1].tolist(), path[1:].tolist()):
+            start, end = self.offsets[u], self.offsets[u + 1]
+            keep = (self.targets[start:end] == v) & ((self.modes[start:end] & bit) != 0)
+            length += float(self.lengths[start:end][keep].min())
+        return length
+
+    def node_modes(self):
+        """
+        Returns the mode bitmask of every node, from the edges leaving or reaching it.
+        """
+        node_modes = np.zeros(self.num_nodes, dtype=np.uint8)
+        sources = np.repeat(np.arange(self.num_nodes), np.diff(self.offsets))
+        np.bitwise_or.at(node_modes, sources, self.modes)
+        np.bitwise_or.at(node_modes, self.targets, self.modes)
+        return node_modes
+
+    def to_scipy(self, mode):
+        """
+        Returns the edges open to mode as a scipy.sparse adjacency matrix of lengths.
+        """
+        keep = (self.modes & MODES[mode]) != 0
+        sources = np.repeat(np.arange(self.num_nodes), np.diff(self.offsets))
+        offsets = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources[keep], minlength=self.num_nodes), out=offsets[1:])
+        return csr_matrix((self.lengths[keep].astype(np.float64), self.targets[keep], offsets),
+                          shape=(self.num_nodes, self.num_nodes))
+
+    def reverse(self):
+        """
+        Returns the graph with every edge flipped, sharing the node arrays.
+        Built on first use and kept, so it travels with the graph to workers.
+        """
+        if self._reverse is None:
+            sources = np.repeat(np.arange(self.num_nodes, dtype=np.int32), np.diff(self.offsets))
+            order = np.argsort(self.targets, kind="stable")
+            offsets = np.zeros(self.num_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.targets, minlength=self.num_nodes), out=offsets[1:])
+            reverse = CSRGraph(offsets, sources[order], self.lengths[order], self.modes[order],
+                               self.lat, self.lon, self.osmids, fingerprint=self.fingerprint)
+            reverse.corridor = self.corridor
+            reverse.components = self.components
+            reverse.hierarchies = self.hierarchies
+            reverse.landmarks = self.landmarks
+            self._reverse = reverse
+        return self._reverse
+
+
+def load_npz(path, mmap=True):
+    """
+    Loads every array of an .npz file. Members stored uncompressed, as
+    np.savez writes them, are memory-mapped read-only instead of read.
+    """
+    if not mmap:
+        with np.load(path) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(zf.open(info))
+                continue
+            # Skip the zip local file header to reach the .npy payload
+            f.seek(info.header_offset)
+            name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or len(shape) == 0 or int(np.prod(shape)) == 0:
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                arrays[name] = np.lib.format.read_array(f)
+                continue
+            # A plain ndarray view keeps the mapping without np.memmap's slow element access
+            arrays[name] = np.asarray(np.memmap(
+                path, dtype=dtype, mode="r", shape=shape,
+                offset=f.tell(), order="F" if fortran_order else "C",
+            ))
+    return arrays
+
+
+def load_csr(G, graph_cache=None, corridor=False):
+    """
+    Returns the CSR form of G, served memory-mapped from graph_cache when possible.
+    Component ids are carried over from G, and with corridor, the nodes'
+    distances to the observed trajectories too.
+    """
+    fingerprint = G.graph.get("fingerprint")
+    if graph_cache is None or fingerprint is None:
+        csr = CSRGraph.from_networkx(G)
+    else:
+        path = graph_cache.get_file(
+            lambda path: CSRGraph.from_networkx(G).save(path), ".npz", graph=fingerprint, format="csr"
+        )
+        csr = CSRGraph.load(path)
+    osmids = csr.osmids.tolist()
+    for mode in MODES:
+        csr.components[mode] = np.array([G.nodes[n][f"component_{mode}"] for n in osmids], dtype=np.int32)
+    if corridor:
+        csr.corridor = np.array([G.nodes[n]["corridor"] for n in osmids], dtype=np.float32)
+    return csr
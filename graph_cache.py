@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import pickle
+
+
+def graph_key(**params):
+    """
+    Returns a stable digest for a set of build parameters.
+    """
+    blob = json.dumps(params, sort_keys=True, default=list)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()[:20]
+
+
+class GraphCache:
+    """
+    On-disk cache for prebuilt road graphs and arrays derived from them.
+    Entries are stored as files named after a digest of the parameters
+    used to build them. The directory is kept under max_size_mb by evicting
+    the least recently used entries.
+    """
+
+    def __init__(self, cache_dir, max_size_mb=2000):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, **params):
+        return graph_key(**params)
+
+    def path(self, key, suffix=".pkl"):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get_graph(self, build, **params):
+        """
+        Returns the cached graph for params, calling build() on a miss.
+        """
+        path = self.path(self.key(**params))
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                G = pickle.load(f)
+            self.touch(path)
+            self.hits += 1
+            return G
+
+        self.misses += 1
+        G = build()
+        self.put(path, G)
+        return G
+
+    def get_file(self, write, suffix, **params):
+        """
+        Returns the path of the cached file for params, calling write(path) on a miss.
+        """
+        path = self.path(self.key(**params), suffix)
+        if os.path.exists(path):
+            self.touch(path)
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        write(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.evict(keep=path)
+        return path
+
+    def put(self, path, obj):
+        """
+        Atomically writes obj to path and enforces the disk budget.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def touch(self, path):
+        """
+        Marks an entry as recently used.
+        """
+        os.utime(path, None)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits its budget.
+        The entry at keep is never evicted, even if it alone exceeds the budget.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isfile(path) and not name.endswith(".tmp"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses"
@@ -0,0 +1,449 @@
+import hashlib
+import math
+import os
+
+import networkx as nx
+import numpy as np
+import osmnx as ox
+from shapely.geometry import box
+from sklearn.neighbors import BallTree
+
+from graph_cache import graph_key
+
+########################
+# Mode masks
+########################
+# Every edge of the "all" network carries a bitmask of the modes allowed on it.
+# The highway filters mirror the ones osmnx uses for its "walk" and "drive"
+# network types, and simplification keeps the nodes where the modes change,
+# so masked views match the graphs it would have downloaded.
+WALK = 1
+DRIVE = 2
+MODES = {"walk": WALK, "drive": DRIVE}
+
+DRIVE_EXCLUDED_HIGHWAYS = {
+    "abandoned", "bridleway", "bus_guideway", "construction", "corridor", "cycleway",
+    "elevator", "escalator", "footway", "no", "path", "pedestrian", "planned", "platform",
+    "proposed", "raceway", "razed", "service", "steps", "track",
+}
+DRIVE_EXCLUDED_SERVICES = {"alley", "driveway", "emergency_access", "parking", "parking_aisle", "private"}
+WALK_EXCLUDED_HIGHWAYS = {
+    "abandoned", "bus_guideway", "construction", "cycleway", "no", "planned", "platform",
+    "proposed", "raceway", "razed",
+}
+# Access tags needed to tell the modes apart, on top of osmnx's defaults
+MODE_TAGS = ["foot", "motor_vehicle", "motorcar"]
+
+EARTH_RADIUS = 6371008.8
+# A route without a path inside the corridor is retried with the corridor
+# widened by these factors, and finally on the whole graph
+CORRIDOR_WIDENING = (1, 4, 16)
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in meters.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def parse_geo(point):
+    """
+    Returns (lat, lon) for a "geo:lat,lon" string.
+    """
+    return tuple(map(float, point.split(':')[1].split(',')))
+
+
+def route_mode(activity):
+    """
+    Returns the graph mode an activity or timeline route is routed on.
+    """
+    return 'walk' if 'walking' in activity['type'].lower() else 'drive'
+
+
+def _tag_values(data, key):
+    """
+    Returns the values of an edge tag as a set; simplified edges may hold lists.
+    """
+    value = data.get(key)
+    if value is None:
+        return set()
+    if isinstance(value, list):
+        return {str(v) for v in value}
+    return {str(value)}
+
+
+def edge_modes(data):
+    """
+    Returns the mode bitmask for one edge's attribute dict.
+    """
+    highways = _tag_values(data, "highway")
+    services = _tag_values(data, "service")
+    # Overpass queries already drop these, local extracts still contain them
+    if not highways or "yes" in _tag_values(data, "area") or "private" in _tag_values(data, "access"):
+        return 0
+    modes = 0
+    if (not highways & DRIVE_EXCLUDED_HIGHWAYS
+            and not services & DRIVE_EXCLUDED_SERVICES
+            and "no" not in _tag_values(data, "motor_vehicle")
+            and "no" not in _tag_values(data, "motorcar")):
+        modes |= DRIVE
+    if (not highways & WALK_EXCLUDED_HIGHWAYS
+            and not any(h.startswith("motor") for h in highways)
+            and "private" not in services
+            and "no" not in _tag_values(data, "foot")):
+        modes |= WALK
+    return modes
+
+
+def annotate_modes(G):
+    """
+    Labels every edge and node of an "all" network with its mode bitmask.
+    Walking ignores one-way restrictions, so walkable edges without a walkable
+    reverse twin get a walk-only reverse edge, as osmnx does for "walk" graphs.
+    """
+    for u, v, data in G.edges(data=True):
+        data["modes"] = edge_modes(data)
+
+    reverse_edges = []
+    for u, v, data in G.edges(data=True):
+        if not data["modes"] & WALK or u == v:
+            continue
+        twins = G.get_edge_data(v, u) or {}
+        if any(twin["modes"] & WALK for twin in twins.values()):
+            continue
+        reverse = {k: val for k, val in data.items() if k != "geometry"}
+        reverse["modes"] = WALK
+        reverse["reversed"] = True
+        reverse_edges.append((v, u, reverse))
+    for v, u, reverse in reverse_edges:
+        G.add_edge(v, u, **reverse)
+
+    for n in G.nodes:
+        G.nodes[n]["modes"] = 0
+    for u, v, data in G.edges(data=True):
+        G.nodes[u]["modes"] |= data["modes"]
+        G.nodes[v]["modes"] |= data["modes"]
+    return G
+
+
+def mode_weight(mode, G=None, corridor_width=None, targets=()):
+    """
+    Returns a networkx weight function that hides edges not open to mode.
+    With a corridor_width, edges leading to nodes further than that from the
+    observed trajectories are hidden too, except edges into targets.
+    """
+    bit = MODES[mode]
+    nodes = G.nodes if corridor_width is not None else None
+
+    def weight(u, v, edges):
+        if nodes is not None and nodes[v]["corridor"] > corridor_width and v not in targets:
+            return None
+        lengths = [d["length"] for d in edges.values() if d["modes"] & bit]
+        return min(lengths) if lengths else None
+
+    return weight
+
+
+def mode_nodes(G, mode, largest_component=False):
+    """
+    Returns the nodes of G that touch at least one edge open to mode,
+    optionally only those in the mode's largest strongly connected component.
+    """
+    bit = MODES[mode]
+    if largest_component:
+        return [n for n, component in G.nodes(data=f"component_{mode}") if component == 0]
+    return [n for n, modes in G.nodes(data="modes") if modes & bit]
+
+
+def annotate_components(G):
+    """
+    Labels every node with its strongly connected component per mode, stored
+    as component_walk and component_drive. Components are numbered by size, so
+    0 is the largest; nodes closed to a mode get -1. Two nodes with different
+    ids cannot reach each other, which routing checks before searching.
+    """
+    for mode, bit in MODES.items():
+        view = nx.subgraph_view(
+            G,
+            filter_node=lambda n, bit=bit: G.nodes[n]["modes"] & bit,
+            filter_edge=lambda u, v, k, bit=bit: G[u][v][k]["modes"] & bit,
+        )
+        components = sorted(nx.strongly_connected_components(view), key=len, reverse=True)
+        key = f"component_{mode}"
+        nx.set_node_attributes(G, -1, key)
+        for component, nodes in enumerate(components):
+            for n in nodes:
+                G.nodes[n][key] = component
+        largest = len(components[0]) if components else 0
+        print(f"{mode}: {len(components)} strongly connected components, the largest has {largest} nodes")
+    return G
+
+
+def index_nodes(G):
+    """
+    Numbers the nodes of G contiguously, storing the map from node id to
+    index as G.graph["node_index"], the node ids in index order as
+    G.graph["node_ids"], and every node's (lat, lon) as rows of the float64
+    array G.graph["node_coords"], so paths turn into coordinates with one
+    fancy-indexing step.
+    """
+    nodes = list(G.nodes)
+    G.graph["node_ids"] = nodes
+    G.graph["node_index"] = {n: i for i, n in enumerate(nodes)}
+    G.graph["node_coords"] = np.array([(G.nodes[n]["y"], G.nodes[n]["x"]) for n in nodes], dtype=np.float64)
+    return G
+
+
+########################
+# Graph loading
+########################
+def fetch_all_network(fetch, simplify):
+    """
+    Downloads an "all" network through fetch and labels its mode masks.
+    With simplify, the graph is simplified only once every edge has its mode
+    mask, keeping nodes where the mask changes as endpoints, so no edge merges
+    ways open to different modes.
+    """
+    ox.settings.useful_tags_way = list(dict.fromkeys(ox.settings.useful_tags_way + MODE_TAGS))
+    G = fetch(network_type="all", simplify=False)
+    if simplify:
+        for u, v, data in G.edges(data=True):
+            data["modes"] = edge_modes(data)
+        G = ox.simplify_graph(G, edge_attrs_differ=["modes"])
+    return annotate_modes(G)
+
+
+def fingerprint_graph(G):
+    """
+    Stores a digest of G's nodes, their coordinates and its edges as
+    G.graph["fingerprint"]. Everything derived from a graph is keyed by it,
+    so a graph rebuilt with different contents never meets the CSR arrays,
+    hierarchies, snapped nodes or routes of the one it replaced.
+    """
+    nodes = list(G.nodes)
+    edges = list(G.edges(data=True))
+    digest = hashlib.sha1()
+    digest.update(np.array(nodes, dtype=np.int64).tobytes())
+    digest.update(np.array([(G.nodes[n]["y"], G.nodes[n]["x"]) for n in nodes], dtype=np.float64).tobytes())
+    digest.update(np.array([(u, v) for u, v, _ in edges], dtype=np.int64).tobytes())
+    digest.update(np.array([(data["length"], data["modes"]) for _, _, data in edges], dtype=np.float64).tobytes())
+    G.graph["fingerprint"] = digest.hexdigest()[:20]
+    return G
+
+
+def graph_from_extract(path, polygon, network_type="all", simplify=True):
+    """
+    Builds a road network from a local .osm or .osm.pbf extract, clipped to polygon.
+    Like ox.graph_from_polygon, it keeps the ways of osmnx's "all" network and
+    the largest weakly connected component, with the same node and edge schema.
+    .osm.pbf files are read with pyrosm, plain .osm XML with osmnx.
+    """
+    if path.endswith(".pbf"):
+        try:
+            from pyrosm import OSM
+        except ImportError:
+            raise ImportError("Reading .osm.pbf extracts requires pyrosm: pip install pyrosm")
+        osm = OSM(path, bounding_box=polygon)
+        nodes, edges = osm.get_network(network_type=network_type, nodes=True, extra_attributes=MODE_TAGS)
+        G = osm.to_graph(nodes, edges, graph_type="networkx", osmnx_compatible=True, retain_all=True)
+    else:
+        G = ox.graph_from_xml(path, bidirectional=False, simplify=False, retain_all=True)
+        G = ox.truncate.truncate_graph_polygon(G, polygon)
+
+    # Drop ways no mode may use, e.g. buildings in a raw XML extract
+    G.remove_edges_from([(u, v, k) for u, v, k, data in G.edges(keys=True, data=True) if not edge_modes(data)])
+    G = G.subgraph(max(nx.weakly_connected_components(G), key=len)).copy()
+    if simplify:
+        G = ox.simplify_graph(G)
+    return G
+
+
+def bbox_around(center_point, dist):
+    """
+    Returns the (south, west, north, east) box reaching dist meters from center_point.
+    """
+    lat, lon = center_point
+    lat_delta = dist / 111320
+    lon_delta = dist / (111320 * math.cos(math.radians(lat)))
+    return (lat - lat_delta, lon - lon_delta, lat + lat_delta, lon + lon_delta)
+
+
+def _extract_params(extract):
+    """
+    Cache key parameters identifying a local extract, or nothing for Overpass.
+    """
+    if not extract:
+        return {}
+    return dict(extract=os.path.abspath(extract), extract_mtime=os.path.getmtime(extract))
+
+
+def load_graph(center_point, dist, simplify=True, graph_cache=None, extract=None):
+    """
+    Returns the "all" road network around center_point with mode masks,
+    served from graph_cache when possible. With extract, the graph is built
+    from that local OSM file instead of querying Overpass.
+    """
+    if extract:
+        south, west, north, east = bbox_around(center_point, dist)
+        polygon = box(west, south, east, north)
+        fetch = lambda **kwargs: graph_from_extract(extract, polygon, **kwargs)
+    else:
+        fetch = lambda **kwargs: ox.graph_from_point(center_point, dist=dist, **kwargs)
+
+    def build():
+        return fingerprint_graph(fetch_all_network(fetch, simplify))
+
+    params = dict(center_point=list(center_point), dist=dist, network_type="all", simplify=simplify,
+                  simplify_by="modes", **_extract_params(extract))
+    G = build() if graph_cache is None else graph_cache.get_graph(build, **params)
+    if "fingerprint" not in G.graph:
+        # Cached before graphs carried their own fingerprint
+        fingerprint_graph(G)
+    return G
+
+
+def load_bbox_graph(bbox, simplify=True, graph_cache=None, extract=None):
+    """
+    Returns the "all" road network inside bbox (south, west, north, east) with mode masks.
+    """
+    south, west, north, east = bbox
+    polygon = box(west, south, east, north)
+    if extract:
+        fetch = lambda **kwargs: graph_from_extract(extract, polygon, **kwargs)
+    else:
+        fetch = lambda **kwargs: ox.graph_from_polygon(polygon, **kwargs)
+
+    def build():
+        return fingerprint_graph(fetch_all_network(fetch, simplify))
+
+    params = dict(bbox=[round(c, 5) for c in bbox], network_type="all", simplify=simplify,
+                  simplify_by="modes", **_extract_params(extract))
+    G = build() if graph_cache is None else graph_cache.get_graph(build, **params)
+    if "fingerprint" not in G.graph:
+        # Cached before graphs carried their own fingerprint
+        fingerprint_graph(G)
+    return G
+
+
+########################
+# Data-driven extent
+########################
+def cluster_points(points, gap):
+    """
+    Groups (lat, lon) points into regions. Points are bucketed into grid cells
+    of roughly gap meters, and touching non-empty cells are merged.
+    Returns a region id per point, with region 0 the largest.
+    """
+    max_lat = min(max(abs(lat) for lat, _ in points), 85.0)
+    lat_step = gap / 111320
+    lon_step = gap / (111320 * math.cos(math.radians(max_lat)))
+    point_cells = [(int(lat // lat_step), int(lon // lon_step)) for lat, lon in points]
+
+    # Union-find over occupied cells
+    parent = {cell: cell for cell in point_cells}
+
+    def find(cell):
+        while parent[cell] != cell:
+            parent[cell] = parent[parent[cell]]
+            cell = parent[cell]
+        return cell
+
+    for i, j in parent:
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                neighbour = (i + di, j + dj)
+                if neighbour in parent:
+                    parent[find(neighbour)] = find((i, j))
+
+    roots = [find(cell) for cell in point_cells]
+    sizes = {}
+    for root in roots:
+        sizes[root] = sizes.get(root, 0) + 1
+    order = sorted(sizes, key=lambda root: -sizes[root])
+    region_of_root = {root: region for region, root in enumerate(order)}
+    return [region_of_root[root] for root in roots]
+
+
+def region_bboxes(points, regions, buffer):
+    """
+    Returns one (south, west, north, east) box per region, grown by buffer meters.
+    """
+    bboxes = {}
+    for (lat, lon), region in zip(points, regions):
+        south, west, north, east = bboxes.get(region, (lat, lon, lat, lon))
+        bboxes[region] = (min(south, lat), min(west, lon), max(north, lat), max(east, lon))
+
+    result = []
+    for region in range(len(bboxes)):
+        south, west, north, east = bboxes[region]
+        lat_buffer = buffer / 111320
+        lon_buffer = buffer / (111320 * math.cos(math.radians(min(max(abs(south), abs(north)), 85.0))))
+        result.append((south - lat_buffer, west - lon_buffer, north + lat_buffer, east + lon_buffer))
+    return result
+
+
+def load_data_graph(points, gap, buffer, simplify=True, graph_cache=None, extract=None):
+    """
+    Fetches one tight graph per cluster of visited points and merges them.
+    Regions stay disconnected from each other, so a search never leaves the
+    region it started in. Nodes carry their region id.
+    Returns the merged graph and the region id of every point.
+    """
+    regions = cluster_points(points, gap)
+    graphs = []
+    for region, bbox in enumerate(region_bboxes(points, regions, buffer)):
+        try:
+            G = load_bbox_graph(bbox, simplify=simplify, graph_cache=graph_cache, extract=extract)
+        except (ox._errors.InsufficientResponseError, ValueError):
+            print(f"No streets found for region {region} {bbox}, skipping")
+            continue
+        nx.set_node_attributes(G, region, "region")
+        graphs.append(G)
+    print(f"Built {len(graphs)} region graphs")
+    G = nx.compose_all(graphs)
+    G.graph["fingerprint"] = graph_key(regions=[g.graph["fingerprint"] for g in graphs])
+    return G, regions
+
+
+########################
+# Trajectory corridors
+########################
+def densify(segments, step):
+    """
+    Returns points every step meters along each ((lat, lon), (lat, lon)) segment.
+    """
+    points = []
+    for (lat1, lon1), (lat2, lon2) in segments:
+        n = max(1, math.ceil(haversine(lat1, lon1, lat2, lon2) / step))
+        for i in range(n + 1):
+            t = i / n
+            points.append((lat1 + t * (lat2 - lat1), lon1 + t * (lon2 - lon1)))
+    return points
+
+
+def annotate_corridor(G, segments, width):
+    """
+    Stores on every node its distance in meters to the observed trajectories,
+    so searches can be pruned to the corridor of the given width around them.
+    """
+    points = np.radians(densify(segments, width / 2))
+    tree = BallTree(points, metric="haversine")
+    nodes = list(G.nodes)
+    coords = np.radians([[G.nodes[n]["y"], G.nodes[n]["x"]] for n in nodes])
+    distances = tree.query(coords, k=1)[0][:, 0] * EARTH_RADIUS
+    for n, distance in zip(nodes, distances):
+        G.nodes[n]["corridor"] = float(distance)
+    print(f"Corridor of {width} m keeps {int((distances <= width).sum())} of {len(nodes)} nodes")
+    return G
+
+
+def corridor_widths(width):
+    """
+    Returns the corridor widths to try in order; None means the whole graph.
+    """
+    if not width:
+        return [None]
+    return [width * factor for factor in CORRIDOR_WIDENING] + [None]
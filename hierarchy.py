@@ -0,0 +1,204 @@
+import heapq
+import math
+
+import numpy as np
+from tqdm import tqdm
+
+from csr_graph import load_npz
+from graphs import MODES
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy over the edges of a CSRGraph open to one mode.
+    Nodes are contracted one by one, adding shortcut edges that keep the
+    shortest paths between the remaining nodes. Node i then keeps its edges to
+    higher ranked nodes, forward in up_* and backward in down_*, so a query only
+    ever climbs the hierarchy from both ends. Shortcuts remember the node they
+    skip (middle, -1 for original edges) to unpack paths to CSR node indices.
+    """
+
+    ARRAYS = ("rank", "up_offsets", "up_targets", "up_lengths", "up_middle",
+              "down_offsets", "down_sources", "down_lengths", "down_middle")
+
+    # Witness searches give up after settling this many nodes and add the shortcut
+    WITNESS_SETTLE_LIMIT = 500
+
+    def __init__(self, rank, up_offsets, up_targets, up_lengths, up_middle,
+                 down_offsets, down_sources, down_lengths, down_middle):
+        self.rank = rank
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_lengths = up_lengths
+        self.up_middle = up_middle
+        self.down_offsets = down_offsets
+        self.down_sources = down_sources
+        self.down_lengths = down_lengths
+        self.down_middle = down_middle
+
+    @classmethod
+    def build(cls, csr, mode):
+        """
+        Contracts the nodes of csr open to mode, least important first. Importance
+        is the edge difference plus the contracted neighbours and shortcut depth.
+        """
+        bit = MODES[mode]
+        n = csr.num_nodes
+        out = [{} for _ in range(n)]
+        inn = [{} for _ in range(n)]
+        # Edge (u, v) -> node skipped by the shortcut
+        middle = {}
+        sources = np.repeat(np.arange(n), np.diff(csr.offsets))
+        mask = (csr.modes & bit) != 0
+        for u, v, length in zip(sources[mask].tolist(), csr.targets[mask].tolist(), csr.lengths[mask].tolist()):
+            if u != v and length < out[u].get(v, math.inf):
+                out[u][v] = length
+                inn[v][u] = length
+
+        contracted = np.zeros(n, dtype=bool)
+        deleted_neighbours = np.zeros(n, dtype=np.int32)
+        # Depth of the shortcuts below a node, keeps contraction spread evenly
+        level = np.zeros(n, dtype=np.int32)
+        rank = np.full(n, n, dtype=np.int32)
+        up = [None] * n
+        down = [None] * n
+
+        def shortcuts(u):
+            needed = []
+            for x, in_length in inn[u].items():
+                targets = {y: in_length + out_length for y, out_length in out[u].items() if y != x}
+                if not targets:
+                    continue
+                witnesses = cls._witness_search(out, x, u, targets, max(targets.values()))
+                for y, length in targets.items():
+                    if witnesses.get(y, math.inf) > length:
+                        needed.append((x, y, length))
+            return needed
+
+        def importance(u):
+            return len(shortcuts(u)) - len(inn[u]) - len(out[u]) + deleted_neighbours[u] + level[u]
+
+        heap = [(importance(u), u) for u in range(n)]
+        heapq.heapify(heap)
+        order = 0
+        with tqdm(total=n, desc=f"Contracting {mode} graph", unit="node") as pbar:
+            while heap:
+                priority, u = heapq.heappop(heap)
+                if contracted[u]:
+                    continue
+                # Lazy update: re-queue if the node became more important than the next one
+                current = importance(u)
+                if heap and current > heap[0][0]:
+                    heapq.heappush(heap, (current, u))
+                    continue
+
+                for x, y, length in shortcuts(u):
+                    if length < out[x].get(y, math.inf):
+                        out[x][y] = length
+                        inn[y][x] = length
+                        middle[(x, y)] = u
+
+                up[u] = [(v, length, middle.get((u, v), -1)) for v, length in out[u].items()]
+                down[u] = [(v, length, middle.get((v, u), -1)) for v, length in inn[u].items()]
+                for v in out[u]:
+                    del inn[v][u]
+                    deleted_neighbours[v] += 1
+                    level[v] = max(level[v], level[u] + 1)
+                for v in inn[u]:
+                    del out[v][u]
+                    deleted_neighbours[v] += 1
+                    level[v] = max(level[v], level[u] + 1)
+                out[u], inn[u] = {}, {}
+                contracted[u] = True
+                rank[u] = order
+                order += 1
+                pbar.update(1)
+
+        return cls(rank, *cls._pack(up), *cls._pack(down))
+
+    @classmethod
+    def _witness_search(cls, out, source, skip, targets, limit):
+        """
+        Dijkstra from source avoiding skip, up to limit meters or WITNESS_SETTLE_LIMIT nodes.
+        Returns the distances found to targets.
+        """
+        distances = {source: 0.0}
+        settled = set()
+        found = {}
+        heap = [(0.0, source)]
+        while heap and len(settled) < cls.WITNESS_SETTLE_LIMIT:
+            distance, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if distance > limit:
+                break
+            settled.add(u)
+            if u in targets:
+                found[u] = distance
+                if len(found) == len(targets):
+                    break
+            for v, length in out[u].items():
+                if v == skip:
+                    continue
+                candidate = distance + length
+                if candidate < distances.get(v, math.inf):
+                    distances[v] = candidate
+                    heapq.heappush(heap, (candidate, v))
+        return found
+
+    @staticmethod
+    def _pack(edges):
+        offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        np.cumsum([len(e) if e else 0 for e in edges], out=offsets[1:])
+        flat = [edge for e in edges if e for edge in e]
+        return (
+            offsets,
+            np.array([e[0] for e in flat], dtype=np.int32),
+            np.array([e[1] for e in flat], dtype=np.float64),
+            np.array([e[2] for e in flat], dtype=np.int32),
+        )
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays = load_npz(path, mmap=mmap)
+        return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def unpack(self, u, v, middle):
+        """
+        Expands the hierarchy edge (u, v) to the original nodes after u, ending at v.
+        """
+        nodes = []
+        stack = [(u, v, middle)]
+        while stack:
+            a, b, m = stack.pop()
+            if m < 0:
+                nodes.append(b)
+                continue
+            # (a, m) is stored backward at m and (m, b) forward at m, both climbing to m's neighbours
+            start, end = self.down_offsets[m], self.down_offsets[m + 1]
+            k = start + self.down_sources[start:end].tolist().index(a)
+            first = (a, m, int(self.down_middle[k]))
+            start, end = self.up_offsets[m], self.up_offsets[m + 1]
+            k = start + self.up_targets[start:end].tolist().index(b)
+            second = (m, b, int(self.up_middle[k]))
+            stack.append(second)
+            stack.append(first)
+        return nodes
+
+
+def load_hierarchy(csr, mode, graph_cache=None):
+    """
+    Returns the contraction hierarchy of csr for mode, built once and kept in
+    graph_cache next to the graph it was built from.
+    """
+    if graph_cache is None or csr.fingerprint is None:
+        return ContractionHierarchy.build(csr, mode)
+    path = graph_cache.get_file(
+        lambda path: ContractionHierarchy.build(csr, mode).save(path), ".npz",
+        graph=csr.fingerprint, format="ch", mode=mode,
+    )
+    return ContractionHierarchy.load(path)
@@ -0,0 +1,104 @@
+import numpy as np
+from scipy.sparse.csgraph import dijkstra as sparse_dijkstra
+
+from csr_graph import load_npz
+from graphs import MODES
+
+
+class LandmarkTable:
+    """
+    Distances between a few landmark nodes and every node of a CSRGraph, over
+    the edges open to one mode, for ALT (A*, landmarks, triangle inequality)
+    lower bounds. Row v of from_distances holds d(landmark, v) and row v of
+    to_distances d(v, landmark), as float32. Unreachable pairs hold UNREACHABLE.
+    """
+
+    ARRAYS = ("landmarks", "from_distances", "to_distances")
+
+    # Stands in for infinity, so differences of two unreachable distances stay 0
+    UNREACHABLE = 1e9
+    # Meters taken off every bound to absorb float32 rounding of the tables
+    SLACK = 1.0
+
+    def __init__(self, landmarks, from_distances, to_distances):
+        self.landmarks = landmarks
+        self.from_distances = from_distances
+        self.to_distances = to_distances
+
+    @classmethod
+    def build(cls, csr, mode, count=16):
+        """
+        Picks count landmarks by farthest selection inside the largest strongly
+        connected component: each new landmark is the node furthest from the
+        ones picked so far, which spreads them towards the border of the graph.
+        """
+        matrix = csr.to_scipy(mode)
+        if mode in csr.components:
+            candidates = np.flatnonzero(csr.components[mode] == 0)
+        else:
+            candidates = np.flatnonzero(csr.node_modes() & MODES[mode])
+        count = min(count, len(candidates))
+
+        # Start from the node furthest from an arbitrary one
+        distances = sparse_dijkstra(matrix, indices=int(candidates[0]))
+        nearest = np.full(csr.num_nodes, np.inf)
+        landmarks, from_rows = [], []
+        following = int(candidates[np.argmax(np.where(np.isinf(distances[candidates]), -1, distances[candidates]))])
+        for _ in range(count):
+            landmarks.append(following)
+            distances = sparse_dijkstra(matrix, indices=following)
+            from_rows.append(distances)
+            nearest = np.minimum(nearest, distances)
+            following = int(candidates[np.argmax(np.where(np.isinf(nearest[candidates]), -1, nearest[candidates]))])
+        to_rows = sparse_dijkstra(matrix.T.tocsr(), indices=landmarks)
+
+        def table(rows):
+            rows = np.minimum(np.asarray(rows), cls.UNREACHABLE)
+            return np.ascontiguousarray(rows.T, dtype=np.float32)
+
+        return cls(np.array(landmarks, dtype=np.int32), table(from_rows), table(to_rows))
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays = load_npz(path, mmap=mmap)
+        return cls(**{name: arrays[name] for name in cls.ARRAYS})
+
+    def potential(self, source, target):
+        """
+        Same as routing.haversine_potential, with the ALT lower bounds
+        d(u, v) >= d(L, v) - d(L, u) and d(u, v) >= d(u, L) - d(v, L) taken
+        over every landmark L.
+        """
+        from_source = self.from_distances[source].astype(np.float64)
+        to_source = self.to_distances[source].astype(np.float64)
+        from_target = self.from_distances[target].astype(np.float64)
+        to_target = self.to_distances[target].astype(np.float64)
+        cache = {}
+
+        def potential(v):
+            if v not in cache:
+                from_v, to_v = self.from_distances[v], self.to_distances[v]
+                to_goal = max(float((from_target - from_v).max()), float((to_v - to_target).max()))
+                from_start = max(float((from_v - from_source).max()), float((to_source - to_v).max()))
+                cache[v] = (max(0.0, to_goal - self.SLACK) - max(0.0, from_start - self.SLACK)) / 2
+            return cache[v]
+
+        return potential
+
+
+def load_landmarks(csr, mode, count=16, graph_cache=None):
+    """
+    Returns the landmark table of csr for mode, built once and kept in
+    graph_cache next to the graph it was built from.
+    """
+    if graph_cache is None or csr.fingerprint is None:
+        return LandmarkTable.build(csr, mode, count)
+    path = graph_cache.get_file(
+        lambda path: LandmarkTable.build(csr, mode, count).save(path), ".npz",
+        graph=csr.fingerprint, format="alt", mode=mode, landmarks=count,
+    )
+    return LandmarkTable.load(path)
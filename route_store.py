@@ -0,0 +1,106 @@
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from csr_graph import CSRGraph
+
+
+class RouteStore:
+    """
+    Persistent map from (graph, mode, start node, end node) to route
+    coordinates and length, shared across runs. Routes are kept in an SQLite
+    file as float64 (lat, lon) blobs next to their length in meters, scoped
+    like SnapCache by the graph fingerprint, the kind of node id and the
+    corridor searches were limited to (see scope).
+    The least recently used routes are dropped once the stored coordinates
+    pass max_size_mb.
+    """
+
+    def __init__(self, path, max_size_mb=500):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(routes)")]
+        if columns and "length" not in columns:
+            # Routes stored without their length cannot be checked against a search budget
+            self.db.execute("DROP TABLE routes")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS routes ("
+            " scope TEXT, mode TEXT, start_node INTEGER, end_node INTEGER, coords BLOB, length REAL, used INTEGER,"
+            " PRIMARY KEY (scope, mode, start_node, end_node))"
+        )
+        self.clock = self.db.execute("SELECT COALESCE(MAX(used), 0) FROM routes").fetchone()[0]
+
+    def scope(self, graph, corridor_width=None):
+        """
+        Returns the scope of routes searched on graph within corridor_width of
+        its corridor (see graphs.annotate_corridor), which is told apart by a
+        digest of every node's distance to the trajectories it was built from.
+        None for a graph without a fingerprint, whose routes are not stored.
+        """
+        kind = "csr" if isinstance(graph, CSRGraph) else "osm"
+        fingerprint = graph.fingerprint if kind == "csr" else graph.graph.get("fingerprint")
+        if fingerprint is None:
+            return None
+        if not corridor_width:
+            return f"{fingerprint}:{kind}:0"
+        if kind == "csr":
+            corridor = graph.corridor
+        else:
+            corridor = [distance for _, distance in graph.nodes(data="corridor")]
+        digest = hashlib.sha1(np.asarray(corridor, dtype=np.float32).tobytes()).hexdigest()[:12]
+        return f"{fingerprint}:{kind}:{corridor_width}:{digest}"
+
+    def get(self, scope, mode, start_node, end_node):
+        """
+        Returns the stored route as an (n, 2) array of (lat, lon) and its
+        length in meters, or None.
+        """
+        row = self.db.execute(
+            "SELECT coords, length FROM routes WHERE scope = ? AND mode = ? AND start_node = ? AND end_node = ?",
+            (scope, mode, int(start_node), int(end_node)),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.clock += 1
+        self.db.execute(
+            "UPDATE routes SET used = ? WHERE scope = ? AND mode = ? AND start_node = ? AND end_node = ?",
+            (self.clock, scope, mode, int(start_node), int(end_node)),
+        )
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float64).reshape(-1, 2), row[1]
+
+    def put(self, scope, mode, start_node, end_node, coords, length):
+        self.clock += 1
+        self.db.execute(
+            "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (scope, mode, int(start_node), int(end_node), np.asarray(coords, dtype=np.float64).tobytes(),
+             float(length), self.clock),
+        )
+
+    def save(self):
+        """
+        Evicts the least recently used routes down to the budget and commits.
+        """
+        total = self.db.execute("SELECT COALESCE(SUM(LENGTH(coords)), 0) FROM routes").fetchone()[0]
+        if total > self.max_bytes:
+            rows = self.db.execute("SELECT rowid, LENGTH(coords) FROM routes ORDER BY used").fetchall()
+            evicted = []
+            for rowid, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append((rowid,))
+                total -= size
+            self.db.executemany("DELETE FROM routes WHERE rowid = ?", evicted)
+        self.db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
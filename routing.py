@@ -0,0 +1,348 @@
+import heapq
+import math
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+
+from graphs import EARTH_RADIUS, MODES, haversine
+
+# Shrinks the straight-line heuristic a little so float32 edge lengths never undercut it
+HEURISTIC_SCALE = 0.999
+# Searches to many targets without an early exit (scipy, networkx) first stop this
+# many times the furthest straight-line distance out, plus a margin in meters
+SPARSE_DETOUR = 3
+SPARSE_MARGIN = 2000
+
+
+class SearchBudgetExceeded(Exception):
+    """
+    Raised when no path within a route's search budget (in meters) exists
+    between two nodes that can reach each other.
+    """
+
+
+########################
+# Search algorithms over a CSRGraph
+########################
+def dijkstra(csr, source, target, mode, corridor_width=None, budget=None):
+    """
+    Shortest path by length from source to target over the edges open to mode.
+    With a corridor_width, nodes further than that from the observed
+    trajectories are skipped, except the target. With a budget, the search
+    gives up once every remaining path is longer than budget meters.
+    Returns the list of node indices, or None if target is unreachable.
+    """
+    bit = MODES[mode]
+    offsets, targets, lengths, modes = csr.offsets, csr.targets, csr.lengths, csr.modes
+    corridor = csr.corridor if corridor_width is not None else None
+    distances = {source: 0.0}
+    previous = {}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap:
+        distance, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        if budget is not None and distance > budget:
+            return None
+        settled.add(u)
+        if u == target:
+            break
+        start, end = offsets[u], offsets[u + 1]
+        for v, length, edge_modes in zip(targets[start:end].tolist(), lengths[start:end].tolist(),
+                                         modes[start:end].tolist()):
+            if not edge_modes & bit:
+                continue
+            if corridor is not None and corridor[v] > corridor_width and v != target:
+                continue
+            candidate = distance + length
+            if candidate < distances.get(v, math.inf):
+                distances[v] = candidate
+                previous[v] = u
+                heapq.heappush(heap, (candidate, v))
+    else:
+        return None
+
+    path = [target]
+    while path[-1] != source:
+        path.append(previous[path[-1]])
+    path.reverse()
+    return path
+
+
+def dijkstra_many(csr, source, targets, mode, corridor_width=None, budget=None):
+    """
+    Same as dijkstra towards several targets at once, stopping once all of them
+    are settled. Targets outside the corridor can be reached but not crossed,
+    so every path matches what dijkstra finds for its target alone. With a
+    budget, targets further than budget meters are left unreachable; callers
+    compare the distances with each route's own budget.
+    Returns a dict of target -> (distance in meters, list of node indices),
+    or None if unreachable.
+    """
+    bit = MODES[mode]
+    offsets, edge_targets, lengths, modes = csr.offsets, csr.targets, csr.lengths, csr.modes
+    corridor = csr.corridor if corridor_width is not None else None
+    wanted = set(targets)
+    remaining = set(wanted)
+    limit = budget if budget is not None else math.inf
+    distances = {source: 0.0}
+    previous = {}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap and remaining:
+        distance, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        if distance > limit:
+            break
+        settled.add(u)
+        remaining.discard(u)
+        if corridor is not None and corridor[u] > corridor_width and u != source:
+            continue
+        start, end = offsets[u], offsets[u + 1]
+        for v, length, edge_modes in zip(edge_targets[start:end].tolist(), lengths[start:end].tolist(),
+                                         modes[start:end].tolist()):
+            if not edge_modes & bit:
+                continue
+            if corridor is not None and corridor[v] > corridor_width and v not in wanted:
+                continue
+            candidate = distance + length
+            if candidate < distances.get(v, math.inf):
+                distances[v] = candidate
+                previous[v] = u
+                heapq.heappush(heap, (candidate, v))
+
+    paths = {}
+    for target in wanted:
+        if target not in settled:
+            paths[target] = None
+            continue
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        path.reverse()
+        paths[target] = (distances[target], path)
+    return paths
+
+
+def haversine_potential(csr, source, target):
+    """
+    Returns p(v) = (h(v, target) - h(v, source)) / 2, with h the great-circle
+    distance in meters. Edge lengths never fall below the great-circle distance
+    between their ends, so searching forward with p and backward with -p
+    keeps every reduced edge cost non-negative.
+    """
+    lat, lon = csr.lat, csr.lon
+    ends = [(math.radians(float(lat[n])), math.radians(float(lon[n]))) for n in (target, source)]
+    scale = HEURISTIC_SCALE * EARTH_RADIUS
+    cache = {}
+
+    def potential(v):
+        if v not in cache:
+            phi, lam = math.radians(float(lat[v])), math.radians(float(lon[v]))
+            h = []
+            for end_phi, end_lam in ends:
+                a = (math.sin((end_phi - phi) / 2) ** 2
+                     + math.cos(phi) * math.cos(end_phi) * math.sin((end_lam - lam) / 2) ** 2)
+                h.append(2 * scale * math.asin(min(1.0, math.sqrt(a))))
+            cache[v] = (h[0] - h[1]) / 2
+        return cache[v]
+
+    return potential
+
+
+def bidirectional_astar(csr, source, target, mode, corridor_width=None, budget=None):
+    """
+    Same contract as dijkstra. Searches forward from source and backward from
+    target at once, both guided towards the other end by haversine_potential,
+    or by the landmark bounds when csr.landmarks holds a table for mode, and
+    stops once the two frontiers prove no shorter meeting point is left.
+    """
+    if source == target:
+        return [source]
+    bit = MODES[mode]
+    corridor = csr.corridor if corridor_width is not None else None
+    table = csr.landmarks.get(mode)
+    if table is not None:
+        potential = table.potential(source, target)
+    else:
+        potential = haversine_potential(csr, source, target)
+    # Per direction: graph, distances, predecessors, settled set, heap, sign of the potential, node kept outside the corridor
+    sides = [
+        (csr, {source: 0.0}, {}, set(), [(potential(source), source)], 1, target),
+        (csr.reverse(), {target: 0.0}, {}, set(), [(-potential(target), target)], -1, source),
+    ]
+    best, meet = math.inf, None
+    while True:
+        tops = [side[4][0][0] if side[4] else math.inf for side in sides]
+        if tops[0] + tops[1] >= best:
+            break
+        # The heap tops bound every path not found yet from below
+        if budget is not None and min(best, tops[0] + tops[1]) > budget:
+            return None
+        side, other = (sides[0], sides[1]) if tops[0] <= tops[1] else (sides[1], sides[0])
+        graph, distances, previous, settled, heap, sign, keep = side
+        other_distances = other[1]
+        _, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        distance = distances[u]
+        start, end = graph.offsets[u], graph.offsets[u + 1]
+        for v, length, edge_modes in zip(graph.targets[start:end].tolist(), graph.lengths[start:end].tolist(),
+                                         graph.modes[start:end].tolist()):
+            if not edge_modes & bit:
+                continue
+            if corridor is not None and corridor[v] > corridor_width and v != keep:
+                continue
+            candidate = distance + length
+            if candidate < distances.get(v, math.inf):
+                distances[v] = candidate
+                previous[v] = u
+                heapq.heappush(heap, (candidate + sign * potential(v), v))
+                if v in other_distances and candidate + other_distances[v] < best:
+                    best, meet = candidate + other_distances[v], v
+
+    if meet is None or (budget is not None and best > budget):
+        return None
+    forward_previous, backward_previous = sides[0][2], sides[1][2]
+    path = [meet]
+    while path[-1] != source:
+        path.append(forward_previous[path[-1]])
+    path.reverse()
+    while path[-1] != target:
+        path.append(backward_previous[path[-1]])
+    return path
+
+
+def hierarchy_search(csr, source, target, mode, corridor_width=None, budget=None):
+    """
+    Same contract as dijkstra, answered from csr.hierarchies[mode] (see
+    hierarchy.ContractionHierarchy). Both ends only climb to higher ranked
+    nodes, then the shortcuts on the best meeting path are unpacked.
+    Modes without a hierarchy fall back to bidirectional_astar. The
+    hierarchy covers the whole graph, so corridor_width is ignored.
+    """
+    ch = csr.hierarchies.get(mode)
+    if ch is None:
+        return bidirectional_astar(csr, source, target, mode, corridor_width, budget)
+    if source == target:
+        return [source]
+
+    up = (ch.up_offsets, ch.up_targets, ch.up_lengths)
+    down = (ch.down_offsets, ch.down_sources, ch.down_lengths)
+    # Per direction: edges climbed, edges arriving from above (for stalling), distances, predecessors, heap
+    sides = [
+        (up, down, {source: 0.0}, {}, [(0.0, source)]),
+        (down, up, {target: 0.0}, {}, [(0.0, target)]),
+    ]
+    best, meet = math.inf, None
+    settled = [set(), set()]
+    while True:
+        tops = [sides[i][4][0][0] if sides[i][4] else math.inf for i in (0, 1)]
+        # Stop once neither side can reach a node closer than best
+        if min(tops) >= best:
+            break
+        if budget is not None and min(best, min(tops)) > budget:
+            return None
+        side = 0 if tops[0] <= tops[1] else 1
+        (offsets, neighbours, lengths), (in_offsets, in_neighbours, in_lengths), distances, previous, heap = sides[side]
+        distance, u = heapq.heappop(heap)
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+        other_distances = sides[1 - side][2]
+        if u in other_distances and distance + other_distances[u] < best:
+            best, meet = distance + other_distances[u], u
+        # Stall on demand: u cannot be on a shortest path if a higher node reaches it cheaper
+        start, end = in_offsets[u], in_offsets[u + 1]
+        if any(distances.get(v, math.inf) + length < distance
+               for v, length in zip(in_neighbours[start:end].tolist(), in_lengths[start:end].tolist())):
+            continue
+        start, end = offsets[u], offsets[u + 1]
+        for k, v, length in zip(range(start, end), neighbours[start:end].tolist(), lengths[start:end].tolist()):
+            candidate = distance + length
+            if candidate < distances.get(v, math.inf):
+                distances[v] = candidate
+                previous[v] = (u, k)
+                heapq.heappush(heap, (candidate, v))
+
+    if meet is None or (budget is not None and best > budget):
+        return None
+    # Climb back down from meet to each end, unpacking shortcuts on the way
+    path = [meet]
+    node = meet
+    while node != source:
+        u, k = sides[0][3][node]
+        path.extend(reversed([u] + ch.unpack(u, node, int(ch.up_middle[k]))[:-1]))
+        node = u
+    path.reverse()
+    node = meet
+    while node != target:
+        v, k = sides[1][3][node]
+        path.extend(ch.unpack(node, v, int(ch.down_middle[k])))
+        node = v
+    return path
+
+
+def sparse_dijkstra_many(csr, source, targets, mode, corridor_width=None, budget=None):
+    """
+    Same contract as dijkstra_many, run in compiled code by
+    scipy.sparse.csgraph over csr.matrices[mode] (built on first use, see
+    CSRGraph.to_scipy). The search is first limited to SPARSE_DETOUR times the
+    furthest straight-line distance to a target, and repeated for targets
+    beyond it, without limit or up to the budget. The matrix holds the whole
+    graph, so corridor_width is ignored.
+    """
+    matrix = csr.matrices.get(mode)
+    if matrix is None:
+        matrix = csr.matrices[mode] = csr.to_scipy(mode)
+    lat, lon = float(csr.lat[source]), float(csr.lon[source])
+    furthest = max(haversine(lat, lon, float(csr.lat[t]), float(csr.lon[t])) for t in targets)
+
+    paths = {}
+    remaining = list(targets)
+    budget = np.inf if budget is None else budget
+    for limit in (min(SPARSE_DETOUR * furthest + SPARSE_MARGIN, budget), budget):
+        distances, predecessors = csgraph_dijkstra(matrix, indices=source, return_predecessors=True, limit=limit)
+        for target in remaining:
+            if target != source and predecessors[target] < 0:
+                continue
+            path = [target]
+            while path[-1] != source:
+                path.append(int(predecessors[path[-1]]))
+            path.reverse()
+            paths[target] = (float(distances[target]), path)
+        remaining = [t for t in remaining if t not in paths]
+        if not remaining or limit == budget:
+            break
+    for target in remaining:
+        paths[target] = None
+    return paths
+
+
+def sparse_dijkstra(csr, source, target, mode, corridor_width=None, budget=None):
+    """
+    Same contract as dijkstra, see sparse_dijkstra_many.
+    """
+    route = sparse_dijkstra_many(csr, source, [target], mode, corridor_width, budget)[target]
+    return None if route is None else route[1]
+
+
+# Searches route_on_csr can run, by routing.backend
+SEARCHES = {"csr": dijkstra, "astar": bidirectional_astar, "ch": hierarchy_search, "scipy": sparse_dijkstra}
+# Backends that answer a group of routes sharing a start with one search
+MANY_SEARCHES = {"csr": dijkstra_many, "scipy": sparse_dijkstra_many}
+
+
+def uses_corridor(csr, backend, mode):
+    """
+    Tells whether the searches of backend for mode stay within csr.corridor.
+    Only then can widening the corridor change a route.
+    """
+    if backend == "scipy":
+        return False
+    if backend == "ch":
+        return mode not in csr.hierarchies
+    return True
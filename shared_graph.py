@@ -0,0 +1,126 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from csr_graph import CSRGraph
+from hierarchy import ContractionHierarchy
+from landmarks import LandmarkTable
+
+
+class SharedGraph:
+    """
+    A CSRGraph exported once into a multiprocessing.shared_memory block, with
+    its reversed edges, components, corridor distances, contraction hierarchies,
+    landmark tables and scipy matrices. Pickling only sends the block name and
+    the array layout, and attach() rebuilds the graph in a worker as read-only
+    views of the block, so workers add next to no memory of their own.
+    """
+
+    # Arrays start on cache line boundaries within the block
+    ALIGNMENT = 64
+
+    def __init__(self, name, layout, fingerprint=None):
+        self.name = name
+        self.layout = layout
+        self.fingerprint = fingerprint
+        self._shm = None
+        self._owner = False
+
+    @classmethod
+    def export(cls, csr):
+        """
+        Copies the arrays of csr into a new shared memory block. The caller
+        owns the block and must close() it once the workers are done.
+        """
+        arrays = cls.flatten(csr)
+        layout = []
+        size = 0
+        for key, array in arrays.items():
+            size = -(-size // cls.ALIGNMENT) * cls.ALIGNMENT
+            layout.append((key, array.dtype.str, array.shape, size))
+            size += array.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for key, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = arrays[key]
+        shared = cls(shm.name, layout, csr.fingerprint)
+        shared._shm = shm
+        shared._owner = True
+        print(f"Shared {len(layout)} graph arrays, {size / 1024 / 1024:.1f} MB")
+        return shared
+
+    @staticmethod
+    def flatten(csr):
+        """
+        Returns every array the searches read from csr, keyed by where it goes.
+        """
+        arrays = {f"graph/{name}": getattr(csr, name) for name in CSRGraph.ARRAYS}
+        if csr.corridor is not None:
+            arrays["corridor"] = csr.corridor
+        for mode, components in csr.components.items():
+            arrays[f"components/{mode}"] = components
+        if csr._reverse is not None:
+            for name in ("offsets", "targets", "lengths", "modes"):
+                arrays[f"reverse/{name}"] = getattr(csr._reverse, name)
+        for mode, ch in csr.hierarchies.items():
+            for name in ContractionHierarchy.ARRAYS:
+                arrays[f"ch/{mode}/{name}"] = getattr(ch, name)
+        for mode, table in csr.landmarks.items():
+            for name in LandmarkTable.ARRAYS:
+                arrays[f"alt/{mode}/{name}"] = getattr(table, name)
+        for mode, matrix in csr.matrices.items():
+            for name in ("data", "indices", "indptr"):
+                arrays[f"matrix/{mode}/{name}"] = getattr(matrix, name)
+        return {key: np.ascontiguousarray(array) for key, array in arrays.items()}
+
+    def __getstate__(self):
+        return {"name": self.name, "layout": self.layout, "fingerprint": self.fingerprint,
+                "_shm": None, "_owner": False}
+
+    def attach(self):
+        """
+        Returns the CSRGraph backed by the shared block, without copying.
+        """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        arrays = {}
+        for key, dtype, shape, offset in self.layout:
+            array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=offset)
+            array.flags.writeable = False
+            arrays[key] = array
+
+        def group(prefix):
+            return {key[len(prefix):]: array for key, array in arrays.items() if key.startswith(prefix)}
+
+        csr = CSRGraph(**group("graph/"), fingerprint=self.fingerprint)
+        csr.corridor = arrays.get("corridor")
+        csr.components = group("components/")
+        modes = {key.split("/")[1] for key in arrays if key.startswith(("ch/", "alt/", "matrix/"))}
+        for mode in modes:
+            if f"ch/{mode}/rank" in arrays:
+                csr.hierarchies[mode] = ContractionHierarchy(**group(f"ch/{mode}/"))
+            if f"alt/{mode}/landmarks" in arrays:
+                csr.landmarks[mode] = LandmarkTable(**group(f"alt/{mode}/"))
+            if f"matrix/{mode}/data" in arrays:
+                matrix = group(f"matrix/{mode}/")
+                csr.matrices[mode] = csr_matrix((matrix["data"], matrix["indices"], matrix["indptr"]),
+                                                shape=(csr.num_nodes, csr.num_nodes), copy=False)
+        if "reverse/offsets" in arrays:
+            reverse = CSRGraph(**group("reverse/"), lat=csr.lat, lon=csr.lon, osmids=csr.osmids,
+                               fingerprint=self.fingerprint)
+            reverse.corridor = csr.corridor
+            reverse.components = csr.components
+            reverse.hierarchies = csr.hierarchies
+            reverse.landmarks = csr.landmarks
+            csr._reverse = reverse
+        return csr
+
+    def close(self):
+        """
+        Releases the block, and frees it if this process created it.
+        """
+        if self._shm is not None:
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
@@ -0,0 +1,149 @@
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from csr_graph import CSRGraph
+from graphs import MODES, mode_nodes, parse_geo, route_mode
+
+
+class SnapIndex:
+    """
+    Prebuilt haversine BallTree over the nodes one mode may snap to.
+    """
+
+    def __init__(self, node_ids, lat, lon):
+        self.node_ids = np.asarray(node_ids)
+        self.tree = BallTree(np.radians(np.column_stack([lat, lon])), metric="haversine")
+
+    @classmethod
+    def for_graph(cls, graph, mode, largest_component=False):
+        """
+        Builds the index for a networkx "all" network (OSM ids) or a CSRGraph (node indices).
+        """
+        if isinstance(graph, CSRGraph):
+            return cls.for_csr(graph, mode, largest_component)
+        nodes = mode_nodes(graph, mode, largest_component)
+        lat = [graph.nodes[n]["y"] for n in nodes]
+        lon = [graph.nodes[n]["x"] for n in nodes]
+        return cls(np.array(nodes, dtype=np.int64), lat, lon)
+
+    @classmethod
+    def for_csr(cls, csr, mode, largest_component=False):
+        if largest_component:
+            nodes = np.flatnonzero(csr.components[mode] == 0)
+        else:
+            nodes = np.flatnonzero(csr.node_modes() & MODES[mode])
+        return cls(nodes, csr.lat[nodes], csr.lon[nodes])
+
+    def query(self, coords):
+        """
+        Returns the nearest node for every (lat, lon) in coords, in one tree query.
+        """
+        _, k = self.tree.query(np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2)), k=1)
+        return self.node_ids[k[:, 0]]
+
+
+class SnapCache:
+    """
+    Persistent map from coordinates to snapped nodes, shared across runs.
+    Coordinates are rounded to precision decimals, and entries are scoped by
+    the fingerprint of the graph's contents, the kind of node id, the mode and whether snapping
+    was limited to the largest component. The least recently used entries are
+    dropped once the estimated size passes max_size_mb.
+    """
+
+    # Rough in-memory cost of one entry: key tuple, floats, node id and dict slot
+    ENTRY_BYTES = 250
+
+    def __init__(self, path, max_size_mb=1000, precision=6):
+        self.path = path
+        self.precision = precision
+        self.max_entries = max(1, int(max_size_mb * 1024 * 1024 // self.ENTRY_BYTES))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.entries = pickle.load(f)
+
+    def scope(self, graph, mode, largest_component):
+        """
+        Returns the key graph's entries are stored under, or None for a graph
+        without a fingerprint (see graphs.fingerprint_graph), whose snapped
+        nodes are not cached.
+        """
+        if isinstance(graph, CSRGraph):
+            fingerprint, kind = graph.fingerprint, "csr"
+        else:
+            fingerprint, kind = graph.graph.get("fingerprint"), "osm"
+        if fingerprint is None:
+            return None
+        return (fingerprint, kind, mode, largest_component)
+
+    def quantize(self, coords):
+        return (round(coords[0], self.precision), round(coords[1], self.precision))
+
+    def get(self, scope, coords):
+        node = self.entries.get((scope, coords))
+        if node is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((scope, coords))
+        self.hits += 1
+        return node
+
+    def put(self, scope, coords, node):
+        self.entries[(scope, coords)] = node
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "wb") as f:
+            pickle.dump(self.entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".tmp", self.path)
+
+    def stats(self):
+        return f"{self.hits} hits, {self.misses} misses, {len(self.entries)} entries"
+
+
+def snap_routes(routes, graph, largest_component=False, snap_cache=None):
+    """
+    Adds start_node and end_node to every route. The unique endpoints of each
+    mode are snapped together in one vectorized query on a prebuilt index,
+    so routing workers receive node ids instead of coordinates.
+    With a snap_cache, coordinates are quantized and only those it does not
+    know yet are queried.
+    """
+    points_by_mode = {}
+    for route in routes:
+        points_by_mode.setdefault(route_mode(route), set()).update((route["start"], route["end"]))
+
+    nodes_by_mode = {}
+    for mode, points in points_by_mode.items():
+        points = sorted(points)
+        coords = [parse_geo(p) for p in points]
+        nodes = [None] * len(points)
+        scope = snap_cache.scope(graph, mode, largest_component) if snap_cache is not None else None
+        if scope is not None:
+            coords = [snap_cache.quantize(c) for c in coords]
+            nodes = [snap_cache.get(scope, c) for c in coords]
+
+        missing = [i for i, node in enumerate(nodes) if node is None]
+        if missing:
+            index = SnapIndex.for_graph(graph, mode, largest_component)
+            for i, node in zip(missing, index.query([coords[i] for i in missing]).tolist()):
+                nodes[i] = node
+                if scope is not None:
+                    snap_cache.put(scope, coords[i], node)
+        nodes_by_mode[mode] = dict(zip(points, nodes))
+        print(f"Snapped {len(points)} unique {mode} endpoints, {len(missing)} queried")
+
+    for route in routes:
+        nodes = nodes_by_mode[route_mode(route)]
+        route["start_node"] = nodes[route["start"]]
+        route["end_node"] = nodes[route["end"]]
+    return routes
@@ -0,0 +1,90 @@
+import random
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from csr_graph import CSRGraph
+from graphs import DRIVE, MODES, WALK, annotate_components, fingerprint_graph, haversine, index_nodes
+
+# Side of the synthetic grid, in nodes, and the spacing of its nodes in degrees
+GRID_SIZE = 12
+GRID_STEP = 0.001
+
+
+def grid_node(i, j):
+    return i * GRID_SIZE + j
+
+
+def grid_geo(node):
+    """
+    Returns the "geo:lat,lon" string of a grid node.
+    """
+    i, j = divmod(node, GRID_SIZE)
+    return f"geo:{38.7 + i * GRID_STEP},{-9.1 + j * GRID_STEP}"
+
+
+def build_grid(seed=0):
+    """
+    Returns a GRID_SIZE x GRID_SIZE "all" network with mode masks, like
+    graphs.fetch_all_network would. Edges are up to 1.5 times longer than
+    the straight line between their ends. Some streets are walk-only, and
+    some are one-way for driving with a walk-only edge back, and the corner
+    node 0 is a dead end for cars.
+    """
+    rng = random.Random(seed)
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(GRID_SIZE):
+        for j in range(GRID_SIZE):
+            G.add_node(grid_node(i, j), y=38.7 + i * GRID_STEP, x=-9.1 + j * GRID_STEP)
+    for i in range(GRID_SIZE):
+        for j in range(GRID_SIZE):
+            u = grid_node(i, j)
+            for v in ([grid_node(i, j + 1)] if j + 1 < GRID_SIZE else []) + \
+                     ([grid_node(i + 1, j)] if i + 1 < GRID_SIZE else []):
+                length = haversine(G.nodes[u]["y"], G.nodes[u]["x"], G.nodes[v]["y"], G.nodes[v]["x"])
+                length *= rng.uniform(1.0, 1.5)
+                kind = rng.random()
+                if kind < 0.15:
+                    forward, backward = WALK, WALK
+                elif kind < 0.35:
+                    forward, backward = WALK | DRIVE, WALK
+                else:
+                    forward, backward = WALK | DRIVE, WALK | DRIVE
+                G.add_edge(u, v, length=length, modes=forward)
+                G.add_edge(v, u, length=length, modes=backward)
+    # Cars can reach the corner node but not leave it
+    for v in (grid_node(0, 1), grid_node(1, 0)):
+        G[grid_node(0, 0)][v][0]["modes"] = WALK
+        G[v][grid_node(0, 0)][0]["modes"] = WALK | DRIVE
+    for n in G.nodes:
+        G.nodes[n]["modes"] = 0
+    for u, v, data in G.edges(data=True):
+        G.nodes[u]["modes"] |= data["modes"]
+        G.nodes[v]["modes"] |= data["modes"]
+    fingerprint_graph(G)
+    annotate_components(G)
+    index_nodes(G)
+    return G
+
+
+def build_csr(G):
+    """
+    Returns the CSRGraph of G with its component ids, as calculate_routes uses it.
+    """
+    csr = CSRGraph.from_networkx(G)
+    for mode in MODES:
+        csr.components[mode] = np.array([G.nodes[n][f"component_{mode}"] for n in csr.osmids.tolist()],
+                                        dtype=np.int32)
+    csr.reverse()
+    return csr
+
+
+@pytest.fixture
+def grid():
+    return build_grid()
+
+
+@pytest.fixture
+def grid_csr(grid):
+    return build_csr(grid)
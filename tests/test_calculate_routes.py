@@ -0,0 +1,76 @@
+import random
+
+import numpy as np
+import pytest
+
+from calculate_routes import (BUDGET_EXCEEDED, ROUTE_OK, compute_route_group, compute_single_route,
+                              parallel_preprocess_routes, route_length, route_store_hooks, search_corridor)
+from hierarchy import ContractionHierarchy
+from route_store import RouteStore
+from conftest import build_csr, build_grid, grid_geo
+
+
+def walk(start, end, time, budget=None):
+    """
+    Returns a walking route between two grid nodes, snapped as snap_routes would.
+    """
+    route = {"type": "walking", "time": time, "start": grid_geo(start), "end": grid_geo(end),
+             "start_node": start, "end_node": end}
+    if budget is not None:
+        route["budget"] = budget
+    return route
+
+
+def route_all(routes, graph, route_store=None, backend="networkx", window=2000):
+    lookup, store = route_store_hooks(graph, route_store, 0, backend)
+    return list(parallel_preprocess_routes(routes, graph, max_workers=1, backend=backend, window=window,
+                                           lookup=lookup, store=store))
+
+
+def test_repeats_of_a_stored_route_over_budget_exceed_it(grid, tmp_path):
+    route_store = RouteStore(str(tmp_path / "routes.sqlite"))
+    first, = route_all([walk(5, 130, "t0")], grid, route_store)
+    assert first["coords"] is not None
+
+    # Served from the store, the first repeat exceeds its budget and the others follow it
+    routes = route_all([walk(5, 130, f"t{k}", budget=10.0) for k in range(3)], grid, route_store)
+    assert [route.get("outcome") for route in routes] == [BUDGET_EXCEEDED] * 3
+    assert [route["time"] for route in routes] == ["t0", "t1", "t2"]
+
+
+def test_route_store_scopes_follow_the_searched_corridor(grid_csr, tmp_path):
+    route_store = RouteStore(str(tmp_path / "routes.sqlite"))
+    grid_csr.corridor = np.linspace(0, 1000, grid_csr.num_nodes, dtype=np.float32)
+    scope = route_store.scope(grid_csr, search_corridor(grid_csr, "csr", "walk", 300))
+    assert scope != route_store.scope(grid_csr, None)
+
+    # Another run's trajectories make another corridor
+    other = build_csr(build_grid())
+    other.corridor = grid_csr.corridor[::-1].copy()
+    assert route_store.scope(other, search_corridor(other, "csr", "walk", 300)) != scope
+
+    # scipy searches ignore the corridor, and so do hierarchy searches of their modes
+    assert search_corridor(grid_csr, "scipy", "walk", 300) is None
+    grid_csr.hierarchies["drive"] = ContractionHierarchy.build(grid_csr, "drive")
+    assert search_corridor(grid_csr, "ch", "drive", 300) is None
+    assert search_corridor(grid_csr, "ch", "walk", 300) == 300
+
+
+@pytest.mark.parametrize("corridor_width", [0, 150])
+def test_networkx_groups_match_single_routes(grid, corridor_width):
+    rng = random.Random(1)
+    for n in grid.nodes:
+        grid.nodes[n]["corridor"] = rng.uniform(0, 400)
+    for start in (0, 13, 77):
+        for mode in ("walk", "drive"):
+            routes = []
+            for end in [rng.randrange(144) for _ in range(8)] + [0, start]:
+                route = walk(start, end, f"t{end}", budget=rng.uniform(200, 2000))
+                route["type"] = "walking" if mode == "walk" else "in passenger vehicle"
+                routes.append(route)
+            grouped = compute_route_group(routes, grid, corridor_width, "networkx")
+            single = [compute_single_route(route, grid, corridor_width, "networkx") for route in routes]
+            assert [status for status, _ in grouped] == [status for status, _ in single]
+            for (status, path), (_, single_path) in zip(grouped, single):
+                if status == ROUTE_OK:
+                    assert route_length(grid, path, mode) == pytest.approx(route_length(grid, single_path, mode))
@@ -0,0 +1,22 @@
+from csr_graph import load_csr
+from graph_cache import GraphCache
+from graphs import annotate_components, fingerprint_graph
+from conftest import build_grid
+
+
+def test_fingerprint_follows_graph_contents():
+    assert build_grid().graph["fingerprint"] == build_grid().graph["fingerprint"]
+    assert build_grid(seed=1).graph["fingerprint"] != build_grid().graph["fingerprint"]
+
+
+def test_rebuilt_graph_gets_its_own_csr_arrays(tmp_path):
+    graph_cache = GraphCache(str(tmp_path))
+    G = build_grid()
+    assert load_csr(G, graph_cache).num_nodes == G.number_of_nodes()
+
+    # The same request answered with one node fewer, e.g. after the pickle was evicted
+    rebuilt = build_grid()
+    rebuilt.remove_node(143)
+    fingerprint_graph(annotate_components(rebuilt))
+    assert rebuilt.graph["fingerprint"] != G.graph["fingerprint"]
+    assert load_csr(rebuilt, graph_cache).num_nodes == rebuilt.number_of_nodes()
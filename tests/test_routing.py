@@ -0,0 +1,57 @@
+import random
+
+import numpy as np
+import pytest
+
+from hierarchy import ContractionHierarchy
+from landmarks import LandmarkTable
+from routing import bidirectional_astar, dijkstra, hierarchy_search, sparse_dijkstra
+
+# Pairs of nodes of the 12 x 12 grid routed by every test, the same on every run
+_rng = random.Random(0)
+PAIRS = [(_rng.randrange(144), _rng.randrange(144)) for _ in range(60)] + [(0, 77), (77, 0), (0, 0)]
+
+
+def route_length(csr, path, mode):
+    return None if path is None else csr.path_length(np.array(path), mode)
+
+
+def check_search(csr, search, mode):
+    """
+    Checks that search finds routes as long as dijkstra's for every pair, and
+    that it gives up on exactly the routes longer than their budget.
+    """
+    for source, target in PAIRS:
+        expected = route_length(csr, dijkstra(csr, source, target, mode), mode)
+        path = search(csr, source, target, mode)
+        if expected is None:
+            assert path is None
+            continue
+        assert path[0] == source and path[-1] == target
+        assert route_length(csr, path, mode) == pytest.approx(expected, rel=1e-6)
+        assert search(csr, source, target, mode, budget=expected * 1.01 + 1) is not None
+        if expected > 0:
+            assert search(csr, source, target, mode, budget=expected * 0.99) is None
+
+
+@pytest.mark.parametrize("mode", ["walk", "drive"])
+def test_bidirectional_astar_matches_dijkstra(grid_csr, mode):
+    check_search(grid_csr, bidirectional_astar, mode)
+
+
+@pytest.mark.parametrize("mode", ["walk", "drive"])
+def test_landmark_astar_matches_dijkstra(grid_csr, mode):
+    # The drive tables hold unreachable distances for the dead-end corner
+    grid_csr.landmarks[mode] = LandmarkTable.build(grid_csr, mode, count=4)
+    check_search(grid_csr, bidirectional_astar, mode)
+
+
+@pytest.mark.parametrize("mode", ["walk", "drive"])
+def test_hierarchy_search_matches_dijkstra(grid_csr, mode):
+    grid_csr.hierarchies[mode] = ContractionHierarchy.build(grid_csr, mode)
+    check_search(grid_csr, hierarchy_search, mode)
+
+
+@pytest.mark.parametrize("mode", ["walk", "drive"])
+def test_sparse_dijkstra_matches_dijkstra(grid_csr, mode):
+    check_search(grid_csr, sparse_dijkstra, mode)
@@ -0,0 +1,32 @@
+from csr_graph import CSRGraph
+from graphs import annotate_components, fingerprint_graph
+from snapping import SnapCache, snap_routes
+from conftest import build_csr, build_grid, grid_geo
+
+
+def walk_to(node):
+    return {"type": "walking", "start": grid_geo(0), "end": grid_geo(node)}
+
+
+def test_cached_snaps_do_not_outlive_a_rebuilt_graph(tmp_path):
+    snap_cache = SnapCache(str(tmp_path / "snaps.pkl"))
+    route, = snap_routes([walk_to(143)], build_grid(), snap_cache=snap_cache)
+    assert route["end_node"] == 143
+
+    # Rebuilt under the same parameters without the node the end snapped to
+    rebuilt = build_grid()
+    rebuilt.remove_node(143)
+    fingerprint_graph(annotate_components(rebuilt))
+    route, = snap_routes([walk_to(143)], rebuilt, snap_cache=snap_cache)
+    assert route["end_node"] in rebuilt
+
+
+def test_graphs_without_fingerprint_are_not_cached(tmp_path):
+    snap_cache = SnapCache(str(tmp_path / "snaps.pkl"))
+    csr = CSRGraph.from_networkx(build_grid())
+    csr.fingerprint = None
+    snap_routes([walk_to(143)], csr, snap_cache=snap_cache)
+    assert not snap_cache.entries
+    # The same graph with its fingerprint is cached
+    snap_routes([walk_to(143)], build_csr(build_grid()), snap_cache=snap_cache)
+    assert snap_cache.entries
@@ -0,0 +1,59 @@
+import pickle
+
+import pytest
+
+from calculate_routes import ROUTE_BUDGET_EXCEEDED, compute_single_route
+from graphs import parse_geo
+from routing import SearchBudgetExceeded
+from tiles import TileStore
+from conftest import build_grid, grid_geo
+
+
+@pytest.fixture
+def tile_store(tmp_path, monkeypatch):
+    """
+    A TileStore holding the test grid in tiles of about 2 x 2 nodes. Tiles
+    off the grid are built empty instead of downloaded.
+    """
+    store = TileStore(str(tmp_path), tile_size=0.002)
+    G = build_grid()
+    tiles = {}
+    for u, v, data in G.edges(data=True):
+        tile = tiles.setdefault(store.tile_id(G.nodes[u]["y"], G.nodes[u]["x"]), {"nodes": {}, "adj": {}})
+        for n in (u, v):
+            tile["nodes"][n] = (G.nodes[n]["y"], G.nodes[n]["x"], G.nodes[n]["modes"])
+        tile["adj"].setdefault(u, []).append((v, data["length"], data["modes"]))
+    for tile_id, tile in tiles.items():
+        with open(store.tile_path(tile_id), "wb") as f:
+            pickle.dump(tile, f)
+
+    def build_tile(tile_id):
+        with open(store.tile_path(tile_id), "wb") as f:
+            pickle.dump({"nodes": {}, "adj": {}}, f)
+
+    monkeypatch.setattr(store, "build_tile", build_tile)
+    return store
+
+
+def test_tiled_routes_reach_their_end(tile_store):
+    route = tile_store.route(parse_geo(grid_geo(13)), parse_geo(grid_geo(130)), "walk")
+    assert route[0] == pytest.approx(parse_geo(grid_geo(13)))
+    assert route[-1] == pytest.approx(parse_geo(grid_geo(130)))
+
+
+def test_tiled_search_stops_at_its_bound(tile_store):
+    source = 13
+    with pytest.raises(ValueError):
+        tile_store.shortest_path(source, 130, "walk", parse_geo(grid_geo(source)), max_distance=250)
+    # Only tiles within about 250 m of the source were searched
+    i0, j0 = tile_store.tile_id(*parse_geo(grid_geo(source)))
+    assert all(abs(i - i0) <= 2 and abs(j - j0) <= 2 for i, j in tile_store.loaded)
+
+
+def test_tiled_routes_over_budget_exceed_it(tile_store):
+    start, end = parse_geo(grid_geo(13)), parse_geo(grid_geo(130))
+    route = {"type": "walking", "time": "t0", "start": grid_geo(13), "end": grid_geo(130), "budget": 100.0}
+    assert compute_single_route(route, tile_store) == (ROUTE_BUDGET_EXCEEDED, None)
+    with pytest.raises(SearchBudgetExceeded):
+        tile_store.route(start, end, "walk", budget=100.0)
+    assert tile_store.route(start, end, "walk", budget=1e6)[-1] == pytest.approx(end)
@@ -0,0 +1,225 @@
+import heapq
+import math
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+import osmnx as ox
+from shapely.geometry import box
+
+from graphs import MODES, fetch_all_network, haversine
+from routing import SearchBudgetExceeded
+
+
+class TileStore:
+    """
+    Road network split on a fixed lat/lon grid, one file per tile.
+    Tiles are downloaded the first time they are needed and loaded into memory
+    only when a route's endpoints or search frontier reach them. Loaded tiles
+    are evicted least recently used once their estimated size passes max_memory_mb.
+
+    A tile holds the coordinates and mode masks of the nodes it touches, and
+    the outgoing edges of the nodes that lie inside it. Tiles are built
+    unsimplified, so node ids match across tile borders.
+    """
+
+    # Loaded tiles take roughly this many times their pickled size in memory
+    MEMORY_FACTOR = 4
+    # Searches give up on paths longer than this many times the straight-line
+    # distance between the endpoints plus the margin in meters, so routes
+    # between unconnected nodes do not download the tiles all around them
+    MAX_DETOUR = 3
+    DETOUR_MARGIN = 2000
+
+    def __init__(self, tile_dir, tile_size=0.1, max_memory_mb=1000):
+        self.tile_dir = os.path.join(tile_dir, f"{tile_size:g}")
+        self.tile_size = tile_size
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        self.loaded = OrderedDict()
+        self.loaded_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        os.makedirs(self.tile_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Ship the store to workers without its loaded tiles
+        state = self.__dict__.copy()
+        state["loaded"] = OrderedDict()
+        state["loaded_bytes"] = 0
+        return state
+
+    def tile_id(self, lat, lon):
+        return (math.floor(lat / self.tile_size), math.floor(lon / self.tile_size))
+
+    def tile_path(self, tile_id):
+        return os.path.join(self.tile_dir, f"tile_{tile_id[0]}_{tile_id[1]}.pkl")
+
+    def build_tile(self, tile_id):
+        """
+        Downloads one tile and persists it, unless another process already has.
+        """
+        if os.path.exists(self.tile_path(tile_id)):
+            return
+        south, west = tile_id[0] * self.tile_size, tile_id[1] * self.tile_size
+        polygon = box(west, south, west + self.tile_size, south + self.tile_size)
+        try:
+            G = fetch_all_network(
+                lambda **kwargs: ox.graph_from_polygon(polygon, retain_all=True, truncate_by_edge=True, **kwargs),
+                simplify=False,
+            )
+        except ox._errors.InsufficientResponseError:
+            G = None
+
+        tile = {"nodes": {}, "adj": {}}
+        if G is not None:
+            for n, data in G.nodes(data=True):
+                tile["nodes"][n] = (data["y"], data["x"], data["modes"])
+            for u, v, data in G.edges(data=True):
+                if self.tile_id(G.nodes[u]["y"], G.nodes[u]["x"]) == tile_id:
+                    tile["adj"].setdefault(u, []).append((v, data["length"], data["modes"]))
+
+        # Workers may build the same frontier tile at once: each writes its own
+        # temporary file, and whichever lands last replaces an identical tile
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.tile_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(tile, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.tile_path(tile_id))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def ensure(self, tile_ids):
+        """
+        Makes sure the given tiles exist on disk without loading them.
+        """
+        for tile_id in tile_ids:
+            if not os.path.exists(self.tile_path(tile_id)):
+                self.build_tile(tile_id)
+
+    def tile(self, tile_id):
+        """
+        Returns a tile, loading it (and building it if needed) on first use.
+        """
+        if tile_id in self.loaded:
+            self.loaded.move_to_end(tile_id)
+            return self.loaded[tile_id][0]
+
+        self.ensure([tile_id])
+        path = self.tile_path(tile_id)
+        with open(path, "rb") as f:
+            tile = pickle.load(f)
+        size = os.path.getsize(path) * self.MEMORY_FACTOR
+        self.loaded[tile_id] = (tile, size)
+        self.loaded_bytes += size
+        self.loads += 1
+
+        # Evict cold tiles, never the one just loaded
+        while self.loaded_bytes > self.max_bytes and len(self.loaded) > 1:
+            _, (_, evicted_size) = self.loaded.popitem(last=False)
+            self.loaded_bytes -= evicted_size
+            self.evictions += 1
+        return tile
+
+    def nearest_node(self, lat, lon, mode):
+        """
+        Returns the nearest node open to mode and its (lat, lon), searching the
+        point's tile and then rings of neighbouring tiles until no closer node
+        can lie outside the rings searched so far.
+        """
+        bit = MODES[mode]
+        i0, j0 = self.tile_id(lat, lon)
+        cos_lat = math.cos(math.radians(lat))
+        # Distance from the point to the border of its own tile, in radians
+        south, west = i0 * self.tile_size, j0 * self.tile_size
+        border = math.radians(min(
+            lat - south, south + self.tile_size - lat,
+            (lon - west) * cos_lat, (west + self.tile_size - lon) * cos_lat,
+        ))
+
+        best, best_distance = None, math.inf
+        for ring in range(4):
+            for i in range(i0 - ring, i0 + ring + 1):
+                for j in range(j0 - ring, j0 + ring + 1):
+                    if max(abs(i - i0), abs(j - j0)) != ring:
+                        continue
+                    nodes = self.tile((i, j))["nodes"]
+                    candidates = [(n, y, x) for n, (y, x, modes) in nodes.items()
+                                  if modes & bit and self.tile_id(y, x) == (i, j)]
+                    if not candidates:
+                        continue
+                    # Equirectangular distance is accurate enough to rank candidates
+                    dx = (np.radians([c[2] for c in candidates]) - math.radians(lon)) * cos_lat
+                    dy = np.radians([c[1] for c in candidates]) - math.radians(lat)
+                    distances = np.sqrt(dx * dx + dy * dy)
+                    k = int(np.argmin(distances))
+                    if distances[k] < best_distance:
+                        best, best_distance = candidates[k], distances[k]
+            reach = border + ring * math.radians(self.tile_size) * cos_lat
+            if best is not None and best_distance <= reach:
+                break
+        if best is None:
+            raise ValueError(f"No {mode} node near {lat},{lon}")
+        return best[0], (best[1], best[2])
+
+    def shortest_path(self, source, target, mode, source_coords, max_distance=math.inf, budget=None):
+        """
+        Dijkstra over the tiles, loading each tile when the frontier reaches it.
+        Nodes further than max_distance meters are never expanded, so their
+        tiles are not loaded. A budget in meters stands in for max_distance,
+        raising SearchBudgetExceeded once every remaining path is longer.
+        Returns the route as a list of (lat, lon).
+        """
+        if budget is not None:
+            max_distance = budget
+        bit = MODES[mode]
+        coords = {source: source_coords}
+        distances = {source: 0.0}
+        previous = {}
+        settled = set()
+        heap = [(0.0, source)]
+        while heap:
+            distance, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if distance > max_distance:
+                if budget is not None:
+                    raise SearchBudgetExceeded(f"No path under {budget:.0f} m between {source} and {target}")
+                raise ValueError(f"No path under {max_distance:.0f} m between {source} and {target}")
+            settled.add(u)
+            if u == target:
+                break
+            tile = self.tile(self.tile_id(*coords[u]))
+            for v, length, modes in tile["adj"].get(u, ()):
+                if not modes & bit:
+                    continue
+                candidate = distance + length
+                if candidate < distances.get(v, math.inf):
+                    distances[v] = candidate
+                    previous[v] = u
+                    coords[v] = tile["nodes"][v][:2]
+                    heapq.heappush(heap, (candidate, v))
+        else:
+            raise ValueError(f"No path between {source} and {target}")
+
+        route = [target]
+        while route[-1] != source:
+            route.append(previous[route[-1]])
+        return [coords[n] for n in reversed(route)]
+
+    def route(self, start_coords, end_coords, mode, budget=None):
+        """
+        Routes between two (lat, lon) points, giving up beyond MAX_DETOUR times
+        their snapped nodes' straight-line distance plus DETOUR_MARGIN, or
+        with a budget, see shortest_path.
+        Returns the route as a list of (lat, lon).
+        """
+        start_node, start_node_coords = self.nearest_node(*start_coords, mode)
+        end_node, end_node_coords = self.nearest_node(*end_coords, mode)
+        max_distance = self.MAX_DETOUR * haversine(*start_node_coords, *end_node_coords) + self.DETOUR_MARGIN
+        return self.shortest_path(start_node, end_node, mode, start_node_coords, max_distance, budget)
+
+    def stats(self):
+        return f"{self.loads} tile loads, {self.evictions} evictions, {len(self.loaded)} tiles in memory"